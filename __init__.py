@@ -10,8 +10,9 @@ from nonebot.adapters import Message
 from himibot.plugins.keep_safe import is_banned
 
 from .config import Config
-from .lib.metro import update_metro_data, list_stations
-from .lib.navigate import navigate_metro
+from .lib.metro import (update_metro_data_async, list_stations_async,
+                        start_auto_update)
+from .lib.navigate import navigate_metro_async
 
 __plugin_meta__ = PluginMetadata(
     name="inf-metro",
@@ -22,6 +23,10 @@ __plugin_meta__ = PluginMetadata(
 
 config = get_plugin_config(Config)
 
+# 地图在第一次查询时从本地加载, 更新检查在后台进行, 不阻塞机器人启动
+METRO_UPDATE_INTERVAL = 6 * 60 * 60
+start_auto_update(METRO_UPDATE_INTERVAL)
+
 
 def safe_int_assert(value):
     try:
@@ -64,7 +69,7 @@ async def handle(bot, event, args: Message = CommandArg()):
             return
     if not args:
         await metro_default.finish('请提供起点和终点坐标或站名。')
-    await metro_default.finish(navigate_metro(*args))
+    await metro_default.finish(await navigate_metro_async(*args))
 
 
 @metro_update.handle()
@@ -74,9 +79,9 @@ async def handle(bot, event, args: Message = CommandArg()):
             return
     if args:
         url = args.extract_plain_text()
-        await metro_update.finish(update_metro_data(url))
+        await metro_update.finish(await update_metro_data_async(url))
     else:
-        await metro_update.finish(update_metro_data())
+        await metro_update.finish(await update_metro_data_async())
 
 
 @metro_liststations.handle()
@@ -84,4 +89,4 @@ async def handle(bot, event):
     if event.message_type == 'group':
         if is_banned(event.group_id):
             return
-    await metro_liststations.finish(list_stations())
+    await metro_liststations.finish(await list_stations_async())
@@ -0,0 +1,142 @@
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from lib.metrics import summarize
+from lib.model import Coord2D, MetroMap
+from lib.synthetic import generate_map
+import lib.navigate as navigate
+
+
+def timed(samples: List[float], func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    res = func(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return res
+
+
+def run(
+    stations: int,
+    lines: int | None,
+    queries: int,
+    repeat: int,
+    seed: int,
+) -> Dict[str, Dict[str, float]]:
+    """
+    离线运行各阶段并计时, 返回 阶段 -> 分位数统计
+    """
+    rng = random.Random(seed)
+    samples: Dict[str, List[float]] = {
+        stage: [] for stage in (
+            "generate", "json", "parse", "graph", "spatial", "names",
+            "line_graph", "name_resolve", "nearest", "two_phase",
+            "line_aware", "format",
+        )
+    }
+    data = timed(samples["generate"], generate_map, stations, lines, seed=seed)
+    with tempfile.TemporaryDirectory() as directory:
+        data_file = os.path.join(directory, "metro_data.json")
+        with open(data_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        for _ in range(repeat):
+            with open(data_file, 'rb') as f:
+                raw = timed(samples["json"], lambda: json.loads(f.read()))
+            metro_map = timed(
+                samples["parse"], MetroMap.from_dict, raw, compile=False)
+            timed(samples["graph"], lambda: metro_map.navi_graph.compiled)
+            timed(samples["spatial"], lambda: metro_map.spatial_index)
+            timed(samples["names"], lambda: metro_map.name_index)
+            timed(samples["line_graph"], lambda: metro_map.line_graph)
+        metro_map.compile()
+
+    all_stations = list(metro_map.stations.values())
+    xs = [station.location.x for station in all_stations]
+    zs = [station.location.z for station in all_stations]
+
+    def random_location() -> Coord2D:
+        return Coord2D(rng.uniform(min(xs), max(xs)),
+                       rng.uniform(min(zs), max(zs)))
+
+    def name_query() -> str:
+        """完整站名, 拼音, 或少一个字 / 换一个字的站名"""
+        name = str(rng.choice(all_stations).name)
+        kind = rng.random()
+        if kind < 0.3:
+            return name
+        if kind < 0.5:
+            return metro_map.name_index.entries[
+                rng.choice(all_stations).id].pinyin
+        i = rng.randrange(len(name))
+        if kind < 0.75 and len(name) > 2:
+            return name[:i] + name[i + 1:]
+        return name[:i] + rng.choice("东西南北中山") + name[i + 1:]
+
+    for _ in range(queries):
+        timed(samples["name_resolve"],
+              metro_map.find_station_by_name, name_query())
+        timed(samples["nearest"], metro_map.find_nearest_stations,
+              random_location(), navigate.ENDPOINT_CANDIDATES)
+
+    for _ in range(queries):
+        sources = metro_map.find_nearest_stations(
+            random_location(), navigate.ENDPOINT_CANDIDATES)
+        targets = metro_map.find_nearest_stations(
+            random_location(), navigate.ENDPOINT_CANDIDATES)
+        # 同一组起终点分别用 A* + 拆分和区分线路的寻路
+        itinerary = timed(
+            samples["two_phase"], metro_map.plan_route, sources, targets,
+            walk_weight=navigate.WALK_WEIGHT,
+        )
+        timed(
+            samples["line_aware"], metro_map.plan_route, sources, targets,
+            walk_weight=navigate.WALK_WEIGHT,
+            transfer_cost=navigate.TRANSFER_COST,
+            line_aware=True,
+        )
+        if len(itinerary.legs) > 0:
+            timed(
+                samples["format"], navigate.format_legs_output,
+                itinerary.legs, itinerary.start_walk, itinerary.end_walk,
+                itinerary.distance,
+            )
+
+    return {stage: summarize(values) for stage, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DHW Inf地铁导航基准测试 (合成地图, 无需联网)。")
+    parser.add_argument("--stations", type=int, default=2000,
+                        help="合成地图的站点数")
+    parser.add_argument("--lines", type=int, default=None,
+                        help="线路数, 默认每条线约 20 站")
+    parser.add_argument("--queries", type=int, default=500,
+                        help="每类查询的次数")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="加载和构建阶段的重复次数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true",
+                        help="以 JSON 输出结果, 便于比较")
+    args = parser.parse_args()
+    # 随机查询中无路线很常见, 不逐条打印警告
+    logging.getLogger("lib").setLevel(logging.ERROR)
+
+    results = run(args.stations, args.lines, args.queries,
+                  args.repeat, args.seed)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"{'stage':<14}{'count':>7}{'mean':>10}{'p50':>10}"
+          f"{'p90':>10}{'p99':>10}{'max':>10}  (ms)")
+    for stage, stats in results.items():
+        print(f"{stage:<14}{stats['count']:>7}" + "".join(
+            f"{stats[key]:>10.3f}" for key in ("mean", "p50", "p90", "p99", "max")))
+
+
+if __name__ == "__main__":
+    main()
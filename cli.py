@@ -1,12 +1,19 @@
 import argparse
+import io
+import json
 import logging
-import lib.navigate as navigate
+import os
+import signal
+import sys
+from typing import TextIO
 
-from lib.metro import (list_stations, load_metro_data,
-                       metro_data_url, update_metro_data)
+import lib.daemon as daemon
+from lib.metrics import METRICS
 
+# 地图相关的模块导入较慢, 由守护进程回答时不需要, 在 `run` 中导入
 
-def main():
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="DHW Inf地铁导航工具。")
 
     parser.add_argument(
@@ -16,6 +23,41 @@ def main():
         help="输入起点和终点坐标: 可以是两组坐标，也可以用站名代替任意一组坐标。"
     )
 
+    parser.add_argument(
+        "--matrix",
+        metavar='FILE',
+        help="批量导航: JSON 文件 (- 为标准输入), "
+             '格式为 {"sources": [...], "targets": [...]}, '
+             "每项为站名或 [x, z], 没有 targets 时为起点两两之间"
+    )
+
+    parser.add_argument(
+        "--batch",
+        metavar='FILE',
+        help="流式批量导航: 每行一个查询 (- 为标准输入), 参数同 --metro "
+             '或 JSON 数组如 ["站名", [x, z]]; 每行输出一个 JSON 结果'
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="--batch 使用的进程数"
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=["json", "csv"],
+        default="json",
+        help="批量导航的输出格式"
+    )
+
+    parser.add_argument(
+        "--paths",
+        action="store_true",
+        help="批量导航时同时输出路径"
+    )
+
     parser.add_argument(
         "--liststation",
         action="store_true",
@@ -25,40 +67,198 @@ def main():
     parser.add_argument(
         "--update",
         nargs='?',
-        const=metro_data_url,
+        const="",
         type=str,
         help="更新地铁站数据，可选 URL"
     )
 
+    parser.add_argument(
+        "--precompute",
+        action="store_true",
+        help="预计算全源最短路表并保存, 之后的导航直接查表"
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="输出各阶段耗时, 搜索节点数和缓存命中率 (输出到标准错误)"
+    )
+
+    parser.add_argument(
+        "--serve",
+        nargs='?',
+        const=daemon.SOCKET_PATH,
+        metavar='SOCKET',
+        help="作为守护进程运行, 地图常驻内存; 之后的命令自动交给它执行"
+    )
+
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="不使用守护进程, 总是在本进程内执行"
+    )
+
     parser.add_argument(
         "--debug",
         action="store_true",
         help="开启调试模式"
     )
 
-    # metro_map = MetroMap.from_dict(json.load(f))
+    return parser
 
-    # Try loading from local data
-    try:
-        load_metro_data()
-    except FileNotFoundError:
-        print("File not found")
-    except Exception as e:
-        print(f"An error occurred: {e}")
 
-    args = parser.parse_args()
+def main():
+    args = build_parser().parse_args()
     # 解析 metro 可变参数
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
+    if args.serve:
+        serve(args.serve)
+        return
+    if not args.no_daemon and not args.debug and forward(sys.argv[1:], args):
+        return
+    if args.profile:
+        METRICS.enable()
+    try:
+        with METRICS.trace() as trace:
+            run(args)
+    finally:
+        if args.profile:
+            print(trace.to_text(), file=sys.stderr)
+            print(METRICS.to_text(), file=sys.stderr)
+
+
+def forward(argv: list, args: argparse.Namespace) -> bool:
+    """
+    交给守护进程执行并输出结果; 守护进程不在或无法处理时返回 False
+    """
+    if args.batch:
+        # 批量查询是长时间任务, 在本进程内执行以便流式输出
+        return False
+    stdin = sys.stdin.read() if args.matrix == "-" else ""
+    response = daemon.request({
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "stdin": stdin,
+    })
+    if response is None or not response.get("ok"):
+        if stdin:
+            sys.stdin = io.StringIO(stdin)
+        return False
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return True
+
+
+def serve(path: str):
+    """
+    加载地图和各种索引后在 `path` 上等待请求
+    """
+    from lib.fuzzymatching import lazy_pinyin
+    from lib.metro import get_map, reload_if_changed, start_auto_update
+
+    metro_map = get_map()
+    if metro_map is None:
+        print("No metro map loaded")
+        return
+    lazy_pinyin("")
+    # 只在配置了 `AUTO_UPDATE_INTERVAL` 时联网检查; 其他进程写入的数据文件
+    # 在每个请求前检查
+    start_auto_update()
+    cwd = os.path.realpath(os.getcwd())
+    parser = build_parser()
+
+    def handle(payload: dict) -> dict:
+        # 数据文件是相对于工作目录的, 目录不同时让客户端自己执行
+        if os.path.realpath(payload["cwd"]) != cwd:
+            return {"ok": False, "error": "working directory differs"}
+        args = parser.parse_args(payload["argv"])
+        if args.serve:
+            return {"ok": False, "error": "already serving"}
+        out, err = io.StringIO(), io.StringIO()
+        reload_if_changed()
+        # 只收集这个请求的线程, 不开启全局统计, 也不输出累计值
+        with METRICS.trace(force=args.profile) as trace:
+            run(args, out=out, err=err, stdin=io.StringIO(payload["stdin"]))
+        if args.profile:
+            print(trace.to_text(), file=err)
+        return {"ok": True, "stdout": out.getvalue(), "stderr": err.getvalue()}
+
+    print(f"已加载版本为 {metro_map.version} 的地图，在 {path} 等待请求")
+    # 被 kill 时也要删除套接字文件
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        daemon.serve(handle, path)
+    except KeyboardInterrupt:
+        pass
+
+
+def run(
+    args: argparse.Namespace,
+    out: TextIO | None = None,
+    err: TextIO | None = None,
+    stdin: TextIO | None = None,
+):
+    import lib.navigate as navigate
+    from lib.metro import (list_stations, metro_data_url,
+                           precompute_path_table, update_metro_data)
+
+    out = out or sys.stdout
+    err = err or sys.stderr
+    stdin = stdin or sys.stdin
+    if args.precompute:
+        metro_map = precompute_path_table()
+        if metro_map is None:
+            print("No metro map loaded", file=out)
+            return
+        if not args.metro:
+            print(f"已保存版本为 {metro_map.version} 的最短路表", file=out)
+            return
     if args.metro:
-        print(navigate.navigate_metro(*args.metro))
+        print(navigate.navigate_metro(*args.metro), file=out)
+        return
+    if args.batch:
+        f = stdin if args.batch == "-" else open(
+            args.batch, 'r', encoding='utf-8')
+        try:
+            for result in navigate.navigate_batch(f, args.workers):
+                print(json.dumps(result, ensure_ascii=False),
+                      file=out, flush=True)
+        except ValueError as e:
+            print(e, file=out)
+        finally:
+            if f is not stdin:
+                f.close()
+        return
+    if args.matrix:
+        if args.matrix == "-":
+            query = json.load(stdin)
+        else:
+            with open(args.matrix, 'r', encoding='utf-8') as f:
+                query = json.load(f)
+        sources = query["sources"]
+        targets = query.get("targets")
+        try:
+            metro_map, matrix = navigate.route_matrix(
+                sources, targets, paths=args.paths)
+        except ValueError as e:
+            print(e, file=out)
+            return
+        if targets is None:
+            targets = sources
+        if args.format == "csv":
+            print(navigate.format_matrix_csv(matrix, sources, targets),
+                  end="", file=out)
+        else:
+            print(navigate.format_matrix_json(
+                matrix, sources, targets, str(metro_map.version)), file=out)
         return
     if args.liststation:
-        print(list_stations())
+        print(list_stations(), file=out)
         return
-    if args.update:
-        update_url = args.update
-        print(update_metro_data(update_url))
+    if args.update is not None:
+        update_url = args.update or metro_data_url
+        print(update_metro_data(update_url), file=out)
         return
 
 
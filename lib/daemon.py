@@ -0,0 +1,165 @@
+"""
+常驻进程: 地图和索引保持在内存中, 通过 Unix 域套接字回答 `cli.py` 的请求
+
+每个连接一个请求, 请求和回复都是一行 JSON; 这个模块只依赖标准库,
+客户端不需要导入地图相关的模块
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+from typing import Any, Callable, Dict
+
+
+def default_socket_path() -> str:
+    """
+    放在只有当前用户能访问的目录中: `XDG_RUNTIME_DIR`,
+    没有时为临时目录下按用户区分的子目录 (由 `serve` 以 0700 创建)
+    """
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, "dhwinf-metro.sock")
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(
+        tempfile.gettempdir(), f"dhwinf-metro-{uid}", "daemon.sock")
+
+
+SOCKET_PATH = os.environ.get("METRO_SOCKET") or default_socket_path()
+"""默认的套接字路径, 可以用环境变量 `METRO_SOCKET` 指定"""
+CONNECT_TIMEOUT = 0.5
+"""连接守护进程的超时 (秒), 超时则在本进程内执行"""
+REQUEST_TIMEOUT = 120.0
+
+Handler = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+def available() -> bool:
+    """当前平台是否支持 Unix 域套接字"""
+    return hasattr(socket, "AF_UNIX") and hasattr(os, "getuid")
+
+
+def _private_directory(directory: str) -> bool:
+    """
+    其他用户不能在 `directory` 中替换文件: 属于当前用户或 root,
+    且其他人不可写 (或设置了粘滞位, 如 `/tmp`)
+    """
+    try:
+        info = os.stat(directory)
+    except OSError:
+        return False
+    if info.st_uid not in (os.getuid(), 0):
+        return False
+    return info.st_mode & 0o022 == 0 or info.st_mode & stat.S_ISVTX != 0
+
+
+def trusted(path: str) -> bool:
+    """
+    `path` 是当前用户创建的套接字, 且所在目录不能被其他用户改动;
+    否则可能是其他用户抢先放置的, 不能把参数和输入发给它
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+            and _private_directory(os.path.dirname(os.path.abspath(path))))
+
+
+def request(
+    payload: Dict[str, Any],
+    path: str = SOCKET_PATH,
+) -> Dict[str, Any] | None:
+    """
+    发送一个请求并返回回复; 守护进程不存在, 套接字不可信,
+    无法连接或回复无效时返回 `None`
+    """
+    if not available() or not trusted(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(path)
+            sock.settimeout(REQUEST_TIMEOUT)
+            sock.sendall(json.dumps(payload, ensure_ascii=False)
+                         .encode("utf-8") + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return None
+    try:
+        response = json.loads(b"".join(chunks).decode("utf-8"))
+    except ValueError:
+        return None
+    return response if isinstance(response, dict) else None
+
+
+def running(path: str = SOCKET_PATH) -> bool:
+    response = request({"ping": True}, path)
+    return response is not None and response.get("ok", False)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            payload = json.loads(self.rfile.readline().decode("utf-8"))
+            if payload.get("ping"):
+                response = {"ok": True}
+            else:
+                response = self.server.handler(payload)
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(
+            json.dumps(response, ensure_ascii=False).encode("utf-8"))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, handler: Handler):
+        self.handler = handler
+        super().__init__(path, _RequestHandler)
+
+
+def serve(handler: Handler, path: str = SOCKET_PATH):
+    """
+    在 `path` 上监听直到被中断, 每个请求在单独的线程中由 `handler` 处理
+
+    所在目录不存在时以 0700 创建; 目录可能被其他用户改动, `path` 上已有
+    守护进程, 或残留的文件不属于当前用户时抛出 `RuntimeError`,
+    当前用户残留的套接字文件会被删除
+    """
+    if not available():
+        raise RuntimeError("Unix domain sockets are not supported here")
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not _private_directory(directory):
+        raise RuntimeError(
+            f"`{directory}` is writable by other users, "
+            "set METRO_SOCKET to a private location")
+    if os.path.lexists(path):
+        if not trusted(path):
+            raise RuntimeError(f"`{path}` is not a socket owned by this user")
+        if running(path):
+            raise RuntimeError(f"A daemon is already listening on `{path}`")
+        os.unlink(path)
+    # 创建时就只有当前用户可以连接, 不在 bind 之后再 chmod
+    umask = os.umask(0o177)
+    try:
+        server = _Server(path, handler)
+    finally:
+        os.umask(umask)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
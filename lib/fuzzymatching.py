@@ -1,10 +1,198 @@
-from pypinyin import lazy_pinyin
+from __future__ import annotations
+
+from bisect import insort
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable, List, Set, Tuple
+
 from thefuzz import fuzz
 
+if TYPE_CHECKING:
+    from .model import Station
 
-def fuzzy_match_integrated(str1, str2):
+MATCH_THRESHOLD = 60
+
+
+def lazy_pinyin(text: str) -> List[str]:
+    """
+    `pypinyin` 导入较慢 (约 0.3 秒), 从快照加载地图时用不到, 第一次用时再导入
+    """
+    from pypinyin import lazy_pinyin
+    return lazy_pinyin(text)
+
+
+def weighted_ratio(str1, pinyin1, str2, pinyin2):
+    """字形 0.3 + 拼音 0.7, 拼音已经预先算好"""
     char_similarity = fuzz.ratio(str1, str2)
-    pinyin_similarity = fuzz.ratio(
-        "".join(lazy_pinyin(str1)), "".join(lazy_pinyin(str2))
-    )
+    pinyin_similarity = fuzz.ratio(pinyin1, pinyin2)
     return char_similarity * 0.3 + pinyin_similarity * 0.7
+
+
+def fuzzy_match_integrated(str1, str2):
+    return weighted_ratio(
+        str1, "".join(lazy_pinyin(str1)),
+        str2, "".join(lazy_pinyin(str2)),
+    )
+
+
+def ngrams(name: str, pinyin: str) -> Set[str]:
+    """
+    站名的汉字二元组和拼音三元组, 两端补边界符,
+    这样一两个字的站名也有足够的 gram
+    """
+    chars = f"^{name}$"
+    letters = f"^{pinyin.casefold()}$"
+    return (
+        {"c" + chars[i:i + 2] for i in range(len(chars) - 1)}
+        | {"p" + letters[i:i + 3] for i in range(len(letters) - 2)}
+    )
+
+
+@dataclass
+class NameEntry:
+    """
+    一个站点名及其预先计算的拼音
+    """
+    station_id: str
+    order: int
+    """加入索引的顺序, 分数相同时先加入的优先"""
+    name: str
+    syllables: List[str]
+    pinyin: str
+    initials: str
+    keys: List[str] = field(default_factory=list)
+    """各语言站名 (忽略大小写), 即 `exact` 中的键"""
+
+
+@dataclass
+class StationNameIndex:
+    """
+    站名索引, 地图加载时构建
+
+    查找顺序: 各语言的完整站名 -> 全拼 / 首字母 -> 模糊匹配
+    """
+    exact: Dict[str, str] = field(default_factory=dict)
+    """站名 (任意语言, 忽略大小写) -> 站点 id"""
+    aliases: Dict[str, str | None] = field(default_factory=dict)
+    """全拼 / 首字母 -> 站点 id, 有歧义时为 `None`"""
+    entries: Dict[str, NameEntry] = field(default_factory=dict)
+    """站点 id -> 用于模糊匹配的站名"""
+    grams: Dict[str, Set[str]] = field(default_factory=dict)
+    """n-gram -> 含有它的站点 id, 用于缩小模糊匹配范围"""
+    _exact_owners: Dict[str, List[Tuple[int, str]]] = field(
+        default_factory=dict, repr=False)
+    """站名 -> 所有 `(加入顺序, 站点 id)`, 删除站点时用来重新决定 `exact`"""
+    _alias_owners: Dict[str, List[Tuple[int, str]]] = field(
+        default_factory=dict, repr=False)
+    _counter: int = field(default=0, repr=False)
+
+    @classmethod
+    def build(cls, stations: Iterable[Station], lang: str) -> StationNameIndex:
+        index = cls()
+        for station in stations:
+            index.add(station, lang)
+        return index
+
+    def add(self, station: Station, lang: str):
+        """
+        加入站点; 已有同 id 的站点时替换它, 并保留原来的顺序
+        """
+        if station.id in self.entries:
+            order = self.entries[station.id].order
+            self.remove(station.id)
+        else:
+            order = self._counter
+            self._counter += 1
+        name = station.name.get(lang) or str(station.name)
+        syllables = lazy_pinyin(name)
+        entry = NameEntry(
+            station_id=station.id,
+            order=order,
+            name=name,
+            syllables=syllables,
+            pinyin="".join(syllables),
+            initials="".join(s[0] for s in syllables if s),
+            keys=list({
+                value.casefold(): None for value in station.name.values()}),
+        )
+        self.entries[station.id] = entry
+        for key in entry.keys:
+            insort(self._exact_owners.setdefault(key, []), (order, station.id))
+            self._refresh(key)
+        for alias in {entry.pinyin, entry.initials}:
+            insort(self._alias_owners.setdefault(alias, []), (order, station.id))
+            self._refresh_alias(alias)
+        for gram in ngrams(name, entry.pinyin):
+            self.grams.setdefault(gram, set()).add(station.id)
+
+    def remove(self, station_id: str):
+        entry = self.entries.pop(station_id, None)
+        if entry is None:
+            return
+        for key in entry.keys:
+            self._exact_owners[key].remove((entry.order, station_id))
+            self._refresh(key)
+        for alias in {entry.pinyin, entry.initials}:
+            self._alias_owners[alias].remove((entry.order, station_id))
+            self._refresh_alias(alias)
+        for gram in ngrams(entry.name, entry.pinyin):
+            ids = self.grams[gram]
+            ids.discard(station_id)
+            if len(ids) == 0:
+                del self.grams[gram]
+
+    def _refresh(self, key: str):
+        """先加入的站点优先"""
+        owners = self._exact_owners[key]
+        if len(owners) == 0:
+            del self._exact_owners[key]
+            self.exact.pop(key, None)
+        else:
+            self.exact[key] = owners[0][1]
+
+    def _refresh_alias(self, alias: str):
+        """有多个站点时为 `None`"""
+        owners = self._alias_owners[alias]
+        if len(owners) == 0:
+            del self._alias_owners[alias]
+            self.aliases.pop(alias, None)
+        else:
+            self.aliases[alias] = owners[0][1] if len(owners) == 1 else None
+
+    def shortlist(self, query: str, pinyin: str) -> Iterable[str]:
+        """
+        与查询至少有一个共同 gram 的站点, 它们全部参与打分;
+        一个共同 gram 都没有时退回全部站点
+        """
+        candidates: Set[str] = set()
+        for gram in ngrams(query, pinyin):
+            candidates.update(self.grams.get(gram, ()))
+        if len(candidates) == 0:
+            return self.entries.keys()
+        return candidates
+
+    def resolve(
+        self,
+        query: str,
+        threshold: float = MATCH_THRESHOLD,
+    ) -> str | None:
+        """
+        返回最匹配的站点 id, 模糊匹配分数低于 `threshold` 时为 `None`
+        """
+        station_id = self.exact.get(query.casefold())
+        if station_id is not None:
+            return station_id
+        syllables = lazy_pinyin(query)
+        pinyin = "".join(syllables)
+        station_id = self.aliases.get(pinyin.casefold())
+        if station_id is not None:
+            return station_id
+        best = None
+        for candidate in self.shortlist(query, pinyin):
+            entry = self.entries[candidate]
+            score = weighted_ratio(entry.name, entry.pinyin, query, pinyin)
+            if score < threshold:
+                continue
+            key = (score, -entry.order)
+            if best is None or key > best[0]:
+                best = (key, candidate)
+        return None if best is None else best[1]
@@ -0,0 +1,661 @@
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass, field
+import heapq
+from itertools import count
+import json
+import sys
+from typing import (TYPE_CHECKING, BinaryIO, Callable, Dict, List, Sequence,
+                    Tuple)
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖, 没有时启发函数逐点计算
+    np = None
+
+from .metrics import METRICS
+
+if TYPE_CHECKING:
+    from .model import DistanceMode, MetroMap, NaviGraph
+
+INF = float("inf")
+
+
+def heuristic_table(
+    xs: array,
+    zs: array,
+    targets: Dict[int, float],
+    distance_mode: DistanceMode = "manhattan",
+) -> List[float]:
+    """
+    每个节点到 `targets` (节点 -> 附加代价) 的 `距离 + 代价` 的最小值,
+    作为 A* 启发函数的查表; 有 NumPy 时整体计算
+    """
+    nodes = list(targets)
+    costs = [targets[node] for node in nodes]
+    if np is not None:
+        x = np.frombuffer(xs, dtype=np.float64)
+        z = np.frombuffer(zs, dtype=np.float64)
+        dx = np.abs(x[:, None] - x[nodes])
+        dz = np.abs(z[:, None] - z[nodes])
+        if distance_mode == "manhattan":
+            distances = dx + dz
+        elif distance_mode == "euclidean":
+            distances = np.sqrt(dx * dx + dz * dz)
+        else:
+            raise ValueError(f"Invalid mode `{distance_mode}`")
+        return (distances + np.array(costs)).min(axis=1).tolist()
+    goals = [(xs[node], zs[node], cost) for node, cost in zip(nodes, costs)]
+    if distance_mode == "manhattan":
+        return [
+            min(abs(x - gx) + abs(z - gz) + cost for gx, gz, cost in goals)
+            for x, z in zip(xs, zs)
+        ]
+    elif distance_mode == "euclidean":
+        return [
+            min(((x - gx) ** 2 + (z - gz) ** 2) ** 0.5 + cost
+                for gx, gz, cost in goals)
+            for x, z in zip(xs, zs)
+        ]
+    raise ValueError(f"Invalid mode `{distance_mode}`")
+
+
+@dataclass
+class CompiledGraph:
+    """
+    编译后的导航图, 站点用连续的整数编号, 邻接表为 CSR 格式
+
+    节点 `i` 的邻居为 `neighbors[offsets[i]:offsets[i + 1]]`,
+    对应的 weight 在 `weights` 的同一区间
+    """
+    ids: List[str]
+    """`ids[i]` 为节点 `i` 的站点 id"""
+    index: Dict[str, int]
+    """站点 id -> 节点编号"""
+    offsets: array
+    neighbors: array
+    weights: array
+    xs: array
+    """节点坐标, 用于启发函数"""
+    zs: array
+    _reverse: Tuple[array, array, array] | None = field(
+        default=None, init=False, repr=False, compare=False)
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_navi_graph(cls, graph: NaviGraph) -> CompiledGraph:
+        ids = list(graph.nodes)
+        index = {id: i for i, id in enumerate(ids)}
+        offsets = array("i", [0])
+        neighbors = array("i")
+        weights = array("d")
+        for id in ids:
+            for neighbor_id, weight in graph.routes.get(id, {}).items():
+                if neighbor_id not in index:
+                    continue
+                neighbors.append(index[neighbor_id])
+                weights.append(weight)
+            offsets.append(len(neighbors))
+        locations = [graph.nodes[id].location for id in ids]
+        return cls(
+            ids=ids,
+            index=index,
+            offsets=offsets,
+            neighbors=neighbors,
+            weights=weights,
+            xs=array("d", (loc.x for loc in locations)),
+            zs=array("d", (loc.z for loc in locations)),
+        )
+
+    def manhattan(self, a: int, b: int) -> float:
+        return abs(self.xs[a] - self.xs[b]) + abs(self.zs[a] - self.zs[b])
+
+    def heuristic_table(
+        self,
+        targets: Dict[int, float],
+        distance_mode: DistanceMode = "manhattan",
+    ) -> List[float]:
+        """
+        见 `heuristic_table`
+        """
+        return heuristic_table(self.xs, self.zs, targets, distance_mode)
+
+    @property
+    def reverse(self) -> Tuple[array, array, array]:
+        """
+        反向图的 `(offsets, neighbors, weights)`, 双向搜索时才构建
+        """
+        if self._reverse is None:
+            n = len(self.ids)
+            offsets, neighbors, weights = (
+                self.offsets, self.neighbors, self.weights)
+            r_offsets = array("i", [0]) * (n + 1)
+            for neighbor in neighbors:
+                r_offsets[neighbor + 1] += 1
+            for i in range(n):
+                r_offsets[i + 1] += r_offsets[i]
+            cursor = array("i", r_offsets)
+            r_neighbors = array("i", [0]) * len(neighbors)
+            r_weights = array("d", [0.0]) * len(neighbors)
+            for node in range(n):
+                for k in range(offsets[node], offsets[node + 1]):
+                    target = neighbors[k]
+                    r_neighbors[cursor[target]] = node
+                    r_weights[cursor[target]] = weights[k]
+                    cursor[target] += 1
+            self._reverse = (r_offsets, r_neighbors, r_weights)
+        return self._reverse
+
+    def astar(
+        self,
+        start: int,
+        end: int,
+        heuristic_weight: float = 1.0,
+        h: Callable[[int], float] | None = None,
+        h_table: Sequence[float] | None = None,
+    ) -> Tuple[List[int], float]:
+        """
+        A*, 默认启发函数为到 `end` 的曼哈顿距离,
+        也可以用 `h` 或预先算好的 `h_table` (比如 `heuristic_table`) 指定
+
+        分数只为访问到的节点创建, 堆里用自增计数打破平局,
+        已关闭的节点和过期的堆项直接跳过
+
+        返回节点编号组成的路径和总 weight, 无路径时为 `([], inf)`
+        """
+        offsets, neighbors, weights = self.offsets, self.neighbors, self.weights
+        xs, zs = self.xs, self.zs
+        end_x, end_z = xs[end], zs[end]
+        if h_table is not None:
+            h = h_table.__getitem__
+        elif h is None:
+            def h(node: int) -> float:
+                return abs(xs[node] - end_x) + abs(zs[node] - end_z)
+
+        g_score: Dict[int, float] = {start: 0.0}
+        came_from: Dict[int, int] = {}
+        closed = set()
+        tie = count()
+        open_set = [(heuristic_weight * h(start), next(tie), start)]
+        while open_set:
+            _, _, current = heapq.heappop(open_set)
+            if current in closed:
+                continue
+            if current == end:
+                METRICS.count("astar.expanded", len(closed))
+                return self.construct_path(came_from, start, end), g_score[end]
+            closed.add(current)
+            current_g = g_score[current]
+            for k in range(offsets[current], offsets[current + 1]):
+                neighbor = neighbors[k]
+                tentative_g_score = current_g + weights[k]
+                if tentative_g_score < g_score.get(neighbor, INF):
+                    # 启发函数不一致时允许重新打开
+                    closed.discard(neighbor)
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative_g_score
+                    heapq.heappush(open_set, (
+                        tentative_g_score + heuristic_weight * h(neighbor),
+                        next(tie),
+                        neighbor,
+                    ))
+        METRICS.count("astar.expanded", len(closed))
+        return [], INF
+
+    def bidirectional_astar(
+        self,
+        start: int,
+        end: int,
+        heuristic_weight: float = 1.0,
+    ) -> Tuple[List[int], float]:
+        """
+        双向 A*, 使用平均势函数 `(h_end - h_start) / 2` (曼哈顿距离),
+        正反两侧都是一致的启发, 可以用 `k_f + k_r >= best` 作为终止条件
+
+        返回值同 `astar`
+        """
+        if start == end:
+            return [start], 0.0
+        xs, zs = self.xs, self.zs
+        start_x, start_z = xs[start], zs[start]
+        end_x, end_z = xs[end], zs[end]
+        half = heuristic_weight / 2
+
+        def potential(node: int) -> float:
+            x, z = xs[node], zs[node]
+            return half * (
+                abs(x - end_x) + abs(z - end_z)
+                - abs(x - start_x) - abs(z - start_z)
+            )
+
+        adjacency = (
+            (self.offsets, self.neighbors, self.weights),
+            self.reverse,
+        )
+        sign = (1.0, -1.0)
+        g_score: Tuple[Dict[int, float], Dict[int, float]] = (
+            {start: 0.0}, {end: 0.0})
+        came_from: Tuple[Dict[int, int], Dict[int, int]] = ({}, {})
+        closed = (set(), set())
+        tie = count()
+        open_sets = (
+            [(potential(start), next(tie), start)],
+            [(-potential(end), next(tie), end)],
+        )
+        best, meeting = INF, -1
+        while open_sets[0] and open_sets[1]:
+            if open_sets[0][0][0] + open_sets[1][0][0] >= best:
+                break
+            side = 0 if len(open_sets[0]) <= len(open_sets[1]) else 1
+            _, _, current = heapq.heappop(open_sets[side])
+            if current in closed[side]:
+                continue
+            closed[side].add(current)
+            own, other = g_score[side], g_score[1 - side]
+            offsets, neighbors, weights = adjacency[side]
+            current_g = own[current]
+            for k in range(offsets[current], offsets[current + 1]):
+                neighbor = neighbors[k]
+                tentative_g_score = current_g + weights[k]
+                if tentative_g_score < own.get(neighbor, INF):
+                    closed[side].discard(neighbor)
+                    came_from[side][neighbor] = current
+                    own[neighbor] = tentative_g_score
+                    heapq.heappush(open_sets[side], (
+                        tentative_g_score + sign[side] * potential(neighbor),
+                        next(tie),
+                        neighbor,
+                    ))
+                    if neighbor in other:
+                        total = tentative_g_score + other[neighbor]
+                        if total < best:
+                            best, meeting = total, neighbor
+        if meeting < 0:
+            METRICS.count(
+                "bidirectional.expanded", len(closed[0]) + len(closed[1]))
+            return [], INF
+        path = self.construct_path(came_from[0], start, meeting)
+        current = meeting
+        while current != end:
+            current = came_from[1][current]
+            path.append(current)
+        METRICS.count(
+            "bidirectional.expanded", len(closed[0]) + len(closed[1]))
+        return path, best
+
+    def multi_source_route(
+        self,
+        sources: Dict[int, float],
+        targets: Dict[int, float],
+        h_table: Sequence[float] | None = None,
+    ) -> Tuple[List[int], float]:
+        """
+        多源多汇最短路, 相当于加一个虚拟起点连向 `sources`,
+        `targets` 连向一个虚拟终点, 边权为字典里的值 (比如步行距离)
+
+        启发函数取到各终点的曼哈顿距离加终点代价的最小值, 仍然是一致的;
+        有 NumPy 时预先对所有节点算好 (`heuristic_table`), 不用每次取最小值
+
+        返回路径 (首尾为选中的起终点) 和总代价, 总代价包含两端的附加代价
+        """
+        if len(sources) == 0 or len(targets) == 0:
+            return [], INF
+        offsets, neighbors, weights = self.offsets, self.neighbors, self.weights
+        xs, zs = self.xs, self.zs
+        if h_table is None and np is not None:
+            h_table = self.heuristic_table(targets)
+        if h_table is not None:
+            h = h_table.__getitem__
+        else:
+            goals = [(xs[node], zs[node], cost)
+                     for node, cost in targets.items()]
+
+            def h(node: int) -> float:
+                x, z = xs[node], zs[node]
+                return min(abs(x - gx) + abs(z - gz) + cost
+                           for gx, gz, cost in goals)
+
+        g_score: Dict[int, float] = {}
+        came_from: Dict[int, int] = {}
+        closed = set()
+        tie = count()
+        open_set = []
+        for node, cost in sources.items():
+            if cost < g_score.get(node, INF):
+                g_score[node] = cost
+                heapq.heappush(open_set, (cost + h(node), next(tie), node))
+        best, arrival = INF, -1
+        while open_set:
+            f, _, current = heapq.heappop(open_set)
+            if f >= best:
+                break
+            if current in closed:
+                continue
+            closed.add(current)
+            current_g = g_score[current]
+            if current in targets and current_g + targets[current] < best:
+                best, arrival = current_g + targets[current], current
+            for k in range(offsets[current], offsets[current + 1]):
+                neighbor = neighbors[k]
+                tentative_g_score = current_g + weights[k]
+                if tentative_g_score < g_score.get(neighbor, INF):
+                    closed.discard(neighbor)
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative_g_score
+                    heapq.heappush(open_set, (
+                        tentative_g_score + h(neighbor),
+                        next(tie),
+                        neighbor,
+                    ))
+        if arrival < 0:
+            METRICS.count("multi_source.expanded", len(closed))
+            return [], INF
+        res = [arrival]
+        current = arrival
+        while current in came_from:
+            current = came_from[current]
+            res.append(current)
+        METRICS.count("multi_source.expanded", len(closed))
+        return res[::-1], best
+
+    def dijkstra(self, start: int) -> Tuple[array, array]:
+        """
+        单源最短路, 返回 `(dist, pred)`, 不可达为 `inf` / `-1`
+        """
+        offsets, neighbors, weights = self.offsets, self.neighbors, self.weights
+        dist = array("d", [INF]) * len(self.ids)
+        pred = array("i", [-1]) * len(self.ids)
+        dist[start] = 0.0
+        heap = [(0.0, start)]
+        while heap:
+            d, current = heapq.heappop(heap)
+            if d > dist[current]:
+                continue
+            for k in range(offsets[current], offsets[current + 1]):
+                neighbor = neighbors[k]
+                nd = d + weights[k]
+                if nd < dist[neighbor]:
+                    dist[neighbor] = nd
+                    pred[neighbor] = current
+                    heapq.heappush(heap, (nd, neighbor))
+        METRICS.count("dijkstra.runs")
+        return dist, pred
+
+    @staticmethod
+    def construct_path(came_from, start: int, end: int) -> List[int]:
+        res = []
+        current = end
+        while current != start:
+            res.append(current)
+            current = came_from[current]
+        res.append(start)
+        return res[::-1]
+
+
+@dataclass
+class PathTable:
+    """
+    全源最短路表, 每个源点跑一次 Dijkstra
+
+    `dist[s * n + t]` 为 s 到 t 的距离, `pred[s * n + t]` 为该路径上 t 的前驱
+    """
+    version: str
+    """对应的 `MapVersion`"""
+    ids: List[str]
+    dist: array
+    pred: array
+
+    @classmethod
+    def build(cls, graph: CompiledGraph, version: str) -> PathTable:
+        dist = array("d")
+        pred = array("i")
+        for source in range(graph.size):
+            source_dist, source_pred = graph.dijkstra(source)
+            dist.extend(source_dist)
+            pred.extend(source_pred)
+        return cls(version=version, ids=list(graph.ids), dist=dist, pred=pred)
+
+    def matches(self, graph: CompiledGraph, version: str) -> bool:
+        return self.version == version and self.ids == graph.ids
+
+    def row(self, start: int) -> Tuple[array, array]:
+        """
+        `start` 的整棵最短路树, 与 `CompiledGraph.dijkstra` 的返回值相同
+        """
+        n = len(self.ids)
+        return (
+            self.dist[start * n:(start + 1) * n],
+            self.pred[start * n:(start + 1) * n],
+        )
+
+    def lookup(self, start: int, end: int) -> Tuple[List[int], float]:
+        """
+        查表 + 沿前驱回溯, 返回值同 `CompiledGraph.astar`
+        """
+        n = len(self.ids)
+        row = start * n
+        distance = self.dist[row + end]
+        if distance == INF:
+            return [], INF
+        res = [end]
+        current = end
+        while current != start:
+            current = self.pred[row + current]
+            res.append(current)
+        return res[::-1], distance
+
+    def dump(self, file: BinaryIO):
+        """
+        一行 JSON 头部, 后面是 `dist` 和 `pred` 的原始字节
+        """
+        header = {
+            "version": self.version,
+            "ids": self.ids,
+            "byteorder": sys.byteorder,
+            "itemsize": [self.dist.itemsize, self.pred.itemsize],
+        }
+        file.write(json.dumps(header, ensure_ascii=False).encode("utf-8"))
+        file.write(b"\n")
+        self.dist.tofile(file)
+        self.pred.tofile(file)
+
+    @classmethod
+    def load(cls, file: BinaryIO) -> PathTable:
+        header = json.loads(file.readline().decode("utf-8"))
+        dist = array("d")
+        pred = array("i")
+        if (
+            header["byteorder"] != sys.byteorder
+            or header["itemsize"] != [dist.itemsize, pred.itemsize]
+        ):
+            raise ValueError("Path table was written on another platform")
+        size = len(header["ids"]) ** 2
+        dist.fromfile(file, size)
+        pred.fromfile(file, size)
+        return cls(
+            version=header["version"],
+            ids=header["ids"],
+            dist=dist,
+            pred=pred,
+        )
+
+
+@dataclass
+class LineGraph:
+    """
+    按 `(站点, 线路)` 展开的状态图, 用于区分线路的寻路
+
+    状态之间的边是同一条线上的区间; 同一站点不同线路的状态之间
+    可以换乘, 代价为 `transfer_cost`, 搜索时隐式展开
+    """
+    station_ids: List[str]
+    station_index: Dict[str, int]
+    line_ids: List[str]
+    state_station: array
+    """状态 -> 站点编号"""
+    state_line: array
+    """状态 -> 线路编号"""
+    offsets: array
+    neighbors: array
+    weights: array
+    station_offsets: array
+    """站点 `i` 的所有状态为 `station_states[station_offsets[i]:station_offsets[i + 1]]`"""
+    station_states: array
+    xs: array
+    zs: array
+
+    @classmethod
+    def from_metro_map(cls, metro_map: MetroMap) -> LineGraph:
+        station_ids = list(metro_map.stations)
+        station_index = {id: i for i, id in enumerate(station_ids)}
+        line_ids = list(metro_map.lines)
+        states: Dict[Tuple[int, int], int] = {}
+        state_station = array("i")
+        state_line = array("i")
+        by_station: List[List[int]] = [[] for _ in station_ids]
+        for line_no, line in enumerate(metro_map.lines.values()):
+            for id in line.routes.routes:
+                if id not in station_index:
+                    continue
+                station = station_index[id]
+                states[(station, line_no)] = len(state_station)
+                by_station[station].append(len(state_station))
+                state_station.append(station)
+                state_line.append(line_no)
+        offsets = array("i", [0])
+        neighbors = array("i")
+        weights = array("d")
+        for state in range(len(state_station)):
+            line_no = state_line[state]
+            table = metro_map.lines[line_ids[line_no]].routes.routes
+            for neighbor_id, weight in table[
+                    station_ids[state_station[state]]].items():
+                neighbor = states.get(
+                    (station_index.get(neighbor_id, -1), line_no))
+                if neighbor is None:
+                    continue
+                neighbors.append(neighbor)
+                weights.append(weight)
+            offsets.append(len(neighbors))
+        station_offsets = array("i", [0])
+        station_states = array("i")
+        for station_states_list in by_station:
+            station_states.extend(station_states_list)
+            station_offsets.append(len(station_states))
+        locations = [
+            metro_map.stations[id].location for id in station_ids]
+        return cls(
+            station_ids=station_ids,
+            station_index=station_index,
+            line_ids=line_ids,
+            state_station=state_station,
+            state_line=state_line,
+            offsets=offsets,
+            neighbors=neighbors,
+            weights=weights,
+            station_offsets=station_offsets,
+            station_states=station_states,
+            xs=array("d", (loc.x for loc in locations)),
+            zs=array("d", (loc.z for loc in locations)),
+        )
+
+    def search(
+        self,
+        sources: Dict[int, float],
+        targets: Dict[int, float],
+        transfer_cost: float = 0.0,
+    ) -> Tuple[List[int], float]:
+        """
+        多源多汇 A*, `sources` / `targets` 为站点编号 -> 附加代价
+
+        代价相同时换乘次数少的优先; 启发函数同
+        `CompiledGraph.multi_source_route`
+
+        返回状态编号组成的路径和总代价 (含附加代价和换乘代价)
+        """
+        if len(sources) == 0 or len(targets) == 0:
+            return [], INF
+        offsets, neighbors, weights = self.offsets, self.neighbors, self.weights
+        station_offsets, station_states = (
+            self.station_offsets, self.station_states)
+        state_station = self.state_station
+        xs, zs = self.xs, self.zs
+        if np is not None:
+            h = heuristic_table(xs, zs, targets).__getitem__
+        else:
+            goals = [(xs[node], zs[node], cost)
+                     for node, cost in targets.items()]
+
+            def h(station: int) -> float:
+                x, z = xs[station], zs[station]
+                return min(abs(x - gx) + abs(z - gz) + cost
+                           for gx, gz, cost in goals)
+
+        estimates: Dict[int, float] = {}
+        """站点 -> 启发值, 同一站点的各个状态共用"""
+        score: Dict[int, Tuple[float, int]] = {}
+        """状态 -> `(代价, 换乘次数)`"""
+        came_from: Dict[int, int] = {}
+        closed = set()
+        tie = count()
+        open_set = []
+        for station, cost in sources.items():
+            estimates[station] = h(station)
+            for k in range(station_offsets[station],
+                           station_offsets[station + 1]):
+                state = station_states[k]
+                if (cost, 0) < score.get(state, (INF, 0)):
+                    score[state] = (cost, 0)
+                    heapq.heappush(open_set, (
+                        cost + estimates[station], 0, next(tie), state))
+        best, arrival = (INF, 0), -1
+        while open_set:
+            f, transfers, _, current = heapq.heappop(open_set)
+            if (f, transfers) >= best:
+                break
+            if current in closed:
+                continue
+            closed.add(current)
+            current_g, current_transfers = score[current]
+            station = state_station[current]
+            if station in targets:
+                total = (current_g + targets[station], current_transfers)
+                if total < best:
+                    best, arrival = total, current
+            # 同一条线上的区间, 以及在本站换乘到其他线路
+            moves = [
+                (neighbors[k], current_g + weights[k], current_transfers)
+                for k in range(offsets[current], offsets[current + 1])
+            ]
+            moves.extend(
+                (station_states[k], current_g + transfer_cost,
+                 current_transfers + 1)
+                for k in range(station_offsets[station],
+                               station_offsets[station + 1])
+                if station_states[k] != current
+            )
+            for state, g, state_transfers in moves:
+                if (g, state_transfers) < score.get(state, (INF, 0)):
+                    closed.discard(state)
+                    score[state] = (g, state_transfers)
+                    came_from[state] = current
+                    next_station = state_station[state]
+                    estimate = estimates.get(next_station)
+                    if estimate is None:
+                        estimate = estimates[next_station] = h(next_station)
+                    heapq.heappush(open_set, (
+                        g + estimate, state_transfers, next(tie), state))
+        if arrival < 0:
+            METRICS.count("line_search.expanded", len(closed))
+            return [], INF
+        res = [arrival]
+        current = arrival
+        while current in came_from:
+            current = came_from[current]
+            res.append(current)
+        METRICS.count("line_search.expanded", len(closed))
+        return res[::-1], best[0]
@@ -0,0 +1,81 @@
+"""
+当前地图的持有者
+
+每个版本的地图连同派生结构和查询缓存组成一个 `MapState`, 发布后不再修改;
+查询开始时取一次 `MapHolder.current()` 并一直使用它, 更新在旁边构建好
+新的地图后整体替换, 读者不需要加锁, 也不会看到更新到一半的地图
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import threading
+from typing import Any, Dict
+
+from .cache import LRUCache
+from .model import MetroMap
+
+ENDPOINT_CACHE_SIZE = 1024
+"""每个版本的端点缓存大小: 站名 / `(x, z)` -> 候选站点"""
+ROUTE_CACHE_SIZE = 256
+"""每个版本的路线缓存大小: `(起点候选, 终点候选)` -> 路线及输出文本"""
+
+
+@dataclass(frozen=True)
+class MapState:
+    """
+    一个版本的地图, 派生结构在发布前已经构建好
+
+    缓存随旧版本一起丢弃, 所以键中不需要地图版本
+    """
+    metro_map: MetroMap
+    generation: int
+    """发布的序号, 每次替换加一"""
+    endpoints: LRUCache = field(
+        default_factory=lambda: LRUCache(ENDPOINT_CACHE_SIZE),
+        repr=False, compare=False)
+    routes: LRUCache = field(
+        default_factory=lambda: LRUCache(ROUTE_CACHE_SIZE),
+        repr=False, compare=False)
+
+    @property
+    def version(self) -> str:
+        return str(self.metro_map.version)
+
+    def clear_caches(self):
+        self.endpoints.clear()
+        self.routes.clear()
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            "endpoints": self.endpoints.stats(),
+            "routes": self.routes.stats(),
+        }
+
+
+class MapHolder:
+    """
+    `current` 只读一次属性, 不加锁; `publish` 在锁内编号并替换
+    """
+
+    def __init__(self):
+        self._state: MapState | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def current(self) -> MapState | None:
+        return self._state
+
+    def publish(self, metro_map: MetroMap) -> MapState:
+        """
+        发布新地图, 之后开始的查询都使用它; 调用后不能再修改 `metro_map`
+        """
+        metro_map.compile()
+        with self._lock:
+            self._generation += 1
+            state = MapState(metro_map, self._generation)
+            self._state = state
+        return state
+
+    def clear(self):
+        with self._lock:
+            self._state = None
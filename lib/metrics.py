@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+import json
+import threading
+import time
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    Tuple)
+
+SAMPLE_SIZE = 1024
+"""每个阶段保留最近多少次耗时, 用于计算分位数"""
+
+_NULL_STAGE = nullcontext()
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """最近秩法, `samples` 已排序, `p` 为 0~100"""
+    if len(samples) == 0:
+        return float("nan")
+    rank = max(1, round(p / 100 * len(samples)))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def summarize(
+    samples: Iterable[float],
+    percentiles: Tuple[int, ...] = (50, 90, 99),
+) -> Dict[str, float]:
+    """
+    耗时 (秒) 的次数, 平均, 各分位数和最大值, 单位为毫秒
+    """
+    samples = sorted(s * 1000 for s in samples)
+    nan = float("nan")
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples) if samples else nan,
+        **{f"p{p}": percentile(samples, p) for p in percentiles},
+        "max": samples[-1] if samples else nan,
+    }
+
+
+@dataclass
+class StageStats:
+    """
+    一个阶段的累计耗时 (秒)
+    """
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    samples: Deque[float] = field(
+        default_factory=lambda: deque(maxlen=SAMPLE_SIZE))
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def to_dict(self) -> Dict[str, float]:
+        """单位为毫秒, 分位数只统计最近的 `SAMPLE_SIZE` 次"""
+        return {
+            **summarize(self.samples),
+            "count": self.count,
+            "total": self.total * 1000,
+            "mean": self.total / self.count * 1000 if self.count else 0.0,
+            "max": self.max * 1000,
+        }
+
+
+@dataclass
+class Trace:
+    """
+    一次查询中各阶段的耗时和计数, 由 `Metrics.trace` 收集
+    """
+    stages: List[Tuple[float, int, str, float]] = field(default_factory=list)
+    """`(开始时间, 嵌套深度, 阶段, 耗时)`"""
+    counters: Dict[str, int] = field(default_factory=dict)
+    depth: int = 0
+
+    def to_text(self) -> str:
+        lines = [
+            f"{'  ' * depth}{name}: {seconds * 1000:.3f} ms"
+            for _, depth, name, seconds in sorted(self.stages)
+        ]
+        lines.extend(
+            f"{name}: {value}" for name, value in self.counters.items())
+        return "\n".join(lines)
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start", "trace")
+
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.trace = self.metrics.current_trace()
+        if self.trace is not None:
+            self.trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if self.metrics.enabled:
+            self.metrics.record(self.name, seconds)
+        if self.trace is not None:
+            self.trace.depth -= 1
+            self.trace.stages.append(
+                (self.start, self.trace.depth, self.name, seconds))
+        return False
+
+
+class Metrics:
+    """
+    进程内的计时 / 计数注册表, 默认关闭
+
+    关闭时 `stage` 返回同一个空上下文, `count` 直接返回, 开销可以忽略;
+    `trace(force=True)` 只为当前线程收集, 不开启全局统计
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._forced = 0
+        """进行中的 `trace(force=True)` 个数, 为 0 时关闭状态直接返回"""
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageStats] = {}
+        self._counters: Dict[str, int] = {}
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._local = threading.local()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def stage(self, name: str):
+        """
+        `with METRICS.stage("route"): ...` 记录这一段的耗时
+        """
+        if not self.enabled and (
+                self._forced == 0 or self.current_trace() is None):
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = StageStats()
+            stats.add(seconds)
+
+    def count(self, name: str, value: int = 1):
+        if not self.enabled and self._forced == 0:
+            return
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + value
+        trace = self.current_trace()
+        if trace is not None:
+            trace.counters[name] = trace.counters.get(name, 0) + value
+
+    def register_source(self, name: str, source: Callable[[], Dict[str, Any]]):
+        """
+        导出时调用 `source` 取得额外的统计 (比如缓存命中率)
+        """
+        self._sources[name] = source
+
+    def current_trace(self) -> Trace | None:
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def trace(self, force: bool = False) -> Iterator[Trace]:
+        """
+        收集当前线程在这段时间内的各阶段耗时; 未开启时返回空的 `Trace`
+
+        `force` 为 True 时即使未开启也收集, 但不计入全局统计,
+        其他线程不受影响 (比如守护进程中单个请求的 `--profile`)
+        """
+        trace = Trace()
+        if not self.enabled and not force:
+            yield trace
+            return
+        previous = self.current_trace()
+        self._local.trace = trace
+        if force:
+            with self._lock:
+                self._forced += 1
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+            if force:
+                with self._lock:
+                    self._forced -= 1
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                name: stats.to_dict() for name, stats in self._stages.items()}
+            counters = dict(self._counters)
+        return {
+            "stages": stages,
+            "counters": counters,
+            **{name: source() for name, source in self._sources.items()},
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def to_text(self) -> str:
+        data = self.to_dict()
+        lines = [
+            f"{'stage':<20}{'count':>8}{'mean':>10}{'p50':>10}"
+            f"{'p90':>10}{'p99':>10}{'max':>10}  (ms)"
+        ]
+        for name, stats in data.pop("stages").items():
+            lines.append(f"{name:<20}{stats['count']:>8}" + "".join(
+                f"{stats[key]:>10.3f}"
+                for key in ("mean", "p50", "p90", "p99", "max")))
+        for name, value in data.pop("counters").items():
+            lines.append(f"{name}: {value}")
+        for name, stats in data.items():
+            lines.append(f"{name}: " + ", ".join(
+                f"{key}={value:.3f}" if isinstance(value, float)
+                else f"{key}={value}"
+                for key, value in stats.items()))
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+"""全局注册表, 由 `cli.py --profile` 等开启"""
@@ -1,95 +1,471 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+import pickle
+import threading
+from typing import Tuple
+
 import requests
 
 
-from .model import MetroMap
+from .graph import PathTable
+from .holder import MapHolder, MapState
+from .metrics import METRICS
+from .model import MapDelta, MapVersion, MetroMap
 
 file_path = "metro_data.json"
 tmp_file_path = "stationstmp.json"
+PRECOMPUTE_PATH_TABLE = False
+"""为 True 时在加载 / 更新地图后构建全源最短路表 (已有则直接读取)"""
+USE_SNAPSHOT = True
+"""为 True 时把构建好的地图保存为快照, 数据文件不变时直接读取快照"""
+SNAPSHOT_FORMAT = 4
+"""快照格式版本, 地图相关的类改动后需要递增"""
+DELTA_UPDATE = True
+"""为 True 时只把新旧数据的差异打到已加载的地图上, 不整体重建"""
+AUTO_UPDATE_INTERVAL: float | None = None
+"""后台检查更新的间隔 (秒), `None` 为不自动检查"""
+REQUEST_TIMEOUT = (5, 30)
+"""下载数据的 `(连接, 读取)` 超时 (秒); 更新持有锁, 不能无限等待"""
 metro_data_url = ("https://gitee.com/brokenclouds03/dhwinf-metro-stations"
                   "/raw/master/metro_data.json")
 print_header = "[INF Metro Navigation] "
 version = 0
-MAP = None
+HOLDER = MapHolder()
+"""当前地图, 用 `get_state` / `get_map` 读取, 不要保存其中的地图"""
 LOG_LEVEL = logging.WARNING
 
+logger = logging.getLogger(__name__)
 
-def load_metro_data(file_path=file_path) -> MetroMap:
+_load_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_loaded_file: Tuple[str, Tuple[int, int, int] | None] | None = None
+"""最近一次读取或写入的数据文件及其 `file_signature`"""
+_auto_update_stop: threading.Event | None = None
+
+
+def get_state() -> MapState | None:
     """
-    Will raise exceptions, set global `MAP` and return it.
+    返回当前版本的地图及缓存; 第一次调用时读取本地文件, 本地没有时才下载
+
+    不会因为网络检查更新, 加载失败时返回 `None`;
+    一次查询中应只调用一次, 之后的更新不影响已经取得的版本
     """
+    if HOLDER.current() is None:
+        with _load_lock:
+            if HOLDER.current() is None:
+                try:
+                    load_metro_data()
+                except FileNotFoundError:
+                    update_metro_data()
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+    return HOLDER.current()
 
-    global MAP
 
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-        MAP = MetroMap.from_dict(data)
-        return MAP
+def get_map() -> MetroMap | None:
+    """`get_state` 中的地图, 不要修改"""
+    state = get_state()
+    return None if state is None else state.metro_map
 
 
-def update_metro_data(url=metro_data_url):
-    """新格式文件的更新"""
+def load_metro_data(file_path=file_path) -> MetroMap:
+    """
+    Will raise exceptions, publish the map to `HOLDER` and return it.
+    """
 
-    global MAP
+    with METRICS.stage("load"):
+        # 先取签名再读: 读的过程中文件被替换的话, 下次检查时会再读一遍
+        signature = file_signature(file_path)
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        metro_map = None
+        if USE_SNAPSHOT:
+            metro_map = load_snapshot(file_path, content)
+            METRICS.count(
+                "snapshot.hit" if metro_map is not None else "snapshot.miss")
+        if metro_map is None:
+            with METRICS.stage("build"):
+                metro_map = MetroMap.from_dict(json.loads(content))
+            if USE_SNAPSHOT:
+                save_snapshot(metro_map, content, file_path)
+        attach_path_table(metro_map, file_path)
+        HOLDER.publish(metro_map)
+        _remember_file(file_path, signature)
+    return metro_map
+
+
+def file_signature(data_file=file_path) -> Tuple[int, int, int] | None:
+    """`(inode, 大小, 修改时间)`, 文件被改写或替换时会变化; 不存在时为 `None`"""
     try:
-        print(print_header + "正在检查更新地铁数据")
-        # 下载 JSON 文件
-        response = requests.get(url)
-        response.raise_for_status()  # 检查请求是否成功
+        info = os.stat(data_file)
+    except OSError:
+        return None
+    return info.st_ino, info.st_size, info.st_mtime_ns
+
+
+def _remember_file(data_file, signature: Tuple[int, int, int] | None):
+    global _loaded_file
+    _loaded_file = (os.path.abspath(data_file), signature)
 
-        # 解析 JSON 数据
-        remote_data = response.json()
-        remote_data_raw = json.loads(response.text)
-        remote_data = MetroMap.from_dict(remote_data_raw)
 
-        # 比较版本号
+def reload_if_changed(data_file=file_path) -> bool:
+    """
+    数据文件在上次读取之后被改动 (例如另一个进程执行了更新) 时重新读取并发布,
+    返回是否重新读取; 常驻进程在每个请求前调用, 没有改动时只 stat 一次
+    """
+    signature = file_signature(data_file)
+    if signature is None \
+            or _loaded_file == (os.path.abspath(data_file), signature):
+        return False
+    with _refresh_lock:
+        signature = file_signature(data_file)
+        if _loaded_file == (os.path.abspath(data_file), signature):
+            return False
         try:
-            local_data = load_metro_data()
+            load_metro_data(data_file)
         except Exception as e:
-            print(f"An error occurred: {e}")
-            local_data = None
+            # 同一个损坏的文件不反复读取, 继续使用当前的地图
+            logger.warning(f"Failed to reload `{data_file}`: {e}")
+            _remember_file(data_file, signature)
+            return False
+    return True
+
+
+def snapshot_file(data_file=file_path) -> str:
+    """编译好的地图快照和数据文件放在一起"""
+    return os.path.splitext(data_file)[0] + ".snapshot"
+
+
+def snapshot_key(content: bytes) -> dict:
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+
+
+def load_snapshot(data_file=file_path, content: bytes = b"") -> MetroMap | None:
+    """
+    一行 JSON 头部 (格式, 版本, 源文件哈希), 后面是 pickle 的地图;
+    与 `content` 不一致或读取失败时返回 `None`
+    """
+    path = snapshot_file(data_file)
+    try:
+        with open(path, 'rb') as file:
+            header = json.loads(file.readline().decode("utf-8"))
+            if {k: header.get(k) for k in ("format", "sha256")} \
+                    != snapshot_key(content):
+                logger.info(f"Snapshot `{path}` is outdated")
+                return None
+            metro_map = pickle.loads(file.read())
+        if not isinstance(metro_map, MetroMap) \
+                or str(metro_map.version) != header.get("version"):
+            return None
+        return metro_map
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to load snapshot `{path}`: {e}")
+        return None
+
+
+def save_snapshot(metro_map: MetroMap, content: bytes, data_file=file_path):
+    """
+    保存 `compile()` 之后的地图; 最短路表和 NumPy 数组不会被 pickle,
+    见 `MetroMap.__getstate__`
+    """
+    try:
+        header = {**snapshot_key(content), "version": str(metro_map.version)}
+        write_atomic(
+            snapshot_file(data_file),
+            json.dumps(header).encode("utf-8") + b"\n"
+            + pickle.dumps(metro_map, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to save snapshot: {e}")
+
+
+def path_table_file(data_file=file_path) -> str:
+    """最短路表和数据文件放在一起"""
+    return os.path.splitext(data_file)[0] + ".table"
+
+
+def attach_path_table(
+    metro_map: MetroMap,
+    data_file=file_path,
+    build: bool | None = None,
+):
+    """
+    读取与地图版本一致的最短路表; 没有或过期时,
+    `build` (默认 `PRECOMPUTE_PATH_TABLE`) 为 True 则重新构建并保存
+    """
+    if build is None:
+        build = PRECOMPUTE_PATH_TABLE
+    table_file = path_table_file(data_file)
+    graph = metro_map.navi_graph.compiled
+    version = str(metro_map.version)
+    try:
+        with open(table_file, 'rb') as file:
+            table = PathTable.load(file)
+        if table.matches(graph, version):
+            metro_map.path_table = table
+            return
+        logger.info(f"Path table `{table_file}` is outdated")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to load path table `{table_file}`: {e}")
+    if not build:
+        return
+    table = metro_map.build_path_table()
+    with open(table_file, 'wb') as file:
+        table.dump(file)
+
+
+def precompute_path_table(data_file=file_path) -> MetroMap | None:
+    """
+    构建 (或读取) 当前地图的最短路表, 在副本上挂好后作为新版本发布
+    """
+    metro_map = get_map()
+    if metro_map is None:
+        return None
+    if metro_map.path_table is not None:
+        return metro_map
+    metro_map = metro_map.clone()
+    attach_path_table(metro_map, data_file, build=True)
+    HOLDER.publish(metro_map)
+    return metro_map
+
+
+def meta_file(data_file=file_path) -> str:
+    """数据文件的来源 URL 及 ETag / Last-Modified 记录, 和数据文件放在一起"""
+    return os.path.splitext(data_file)[0] + ".meta.json"
+
+
+def load_meta(data_file=file_path) -> dict:
+    """
+    读取上次下载时的响应头; 数据文件不存在时返回空,
+    这样不会对着一个已经没有的文件发条件请求
+    """
+    if not os.path.exists(data_file):
+        return {}
+    try:
+        with open(meta_file(data_file), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        return meta if isinstance(meta, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomic(path: str, content: bytes):
+    """先写临时文件再重命名, 中途失败不会留下半个文件"""
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_meta(
+    response: requests.Response,
+    version: MapVersion,
+    url: str,
+    data_file=file_path,
+):
+    """记录用于条件请求的响应头; 它们只对请求的 `url` 有效"""
+    meta = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "version": str(version),
+    }
+    write_atomic(
+        meta_file(data_file),
+        json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+    )
+
+
+def save_remote_data(
+    response: requests.Response,
+    version: MapVersion,
+    url: str,
+    data_file=file_path,
+):
+    """原样保存下载的数据, 不再重新序列化"""
+    write_atomic(data_file, response.content)
+    save_meta(response, version, url, data_file)
+
+
+def update_metro_data(url=metro_data_url, data_file=file_path):
+    """新格式文件的更新, 同时只进行一次"""
+    with _refresh_lock, METRICS.stage("update"):
+        return _update_metro_data(url, data_file)
 
+
+def _update_metro_data(url=metro_data_url, data_file=file_path):
+    try:
+        print(print_header + "正在检查更新地铁数据")
+        # 已加载时直接用内存中的地图, 不打断正在进行的查询
+        state = HOLDER.current()
+        local_data = None if state is None else state.metro_map
+        if local_data is None:
+            try:
+                local_data = load_metro_data(data_file)
+            except FileNotFoundError:
+                local_data = None
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                local_data = None
+
+        # 有本地数据时发条件请求, 没有变化的话服务器只回 304;
+        # 记录的响应头来自另一个 URL 时不能发给这个服务器
+        headers = {}
+        if local_data is not None:
+            meta = load_meta(data_file)
+            if meta.get("version") == str(local_data.version) \
+                    and meta.get("url") == url:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+        response = requests.get(
+            url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304 and local_data is not None:
+            return ("当前版本与远程仓库版本一致，"
+                    f"版本均为：{local_data.version}。")
+        response.raise_for_status()  # 检查请求是否成功
+
+        # 解析 JSON 数据, 先只比较版本号, 没有更新时不构建地图
+        remote_data_raw = json.loads(response.content)
+        remote_version = MapVersion.from_str(remote_data_raw["version"])
+        if (local_data is not None
+                and remote_version.data_ver <= local_data.version.data_ver):
+            if remote_version == local_data.version:
+                save_meta(response, remote_version, url, data_file)
+            return ("当前版本与远程仓库版本一致，"
+                    f"版本均为：{remote_version}。")
+        local_version = None if local_data is None else local_data.version
+        remote_data, delta = None, None
+        if (DELTA_UPDATE and local_data is not None
+                and remote_version.format_ver == local_version.format_ver):
+            try:
+                delta = MapDelta.between(
+                    local_data,
+                    MetroMap.from_dict(remote_data_raw, compile=False),
+                )
+                # 正在使用的地图不能修改, 在副本上应用
+                remote_data = local_data.clone().apply_delta(delta)
+            except Exception as e:
+                logger.warning(f"Delta update failed, rebuilding: {e}")
+                remote_data, delta = None, None
+        if remote_data is None:
+            remote_data = MetroMap.from_dict(remote_data_raw)
+
+        # 更新本地数据
+        save_remote_data(response, remote_version, url, data_file)
+        if USE_SNAPSHOT:
+            save_snapshot(remote_data, response.content, data_file)
+        attach_path_table(remote_data, data_file)
+        HOLDER.publish(remote_data)
+        _remember_file(data_file, file_signature(data_file))
         if local_data is None:
             print(print_header +
                   f"无本地文件，已下载版本为 {remote_data.version} 的数据")
-            with open(file_path, 'w', encoding='utf-8') as file:
-                json.dump(remote_data_raw, file, ensure_ascii=False, indent=4)
-            MAP = remote_data
             return "无本地文件，已下载最新数据。"
-        if remote_data.version.data_ver > local_data.version.data_ver:
-            # 更新本地数据
-            with open(file_path, 'w', encoding='utf-8') as file:
-                json.dump(remote_data_raw, file, ensure_ascii=False, indent=4)
-            MAP = remote_data
-            return (f"完成版本更新：{local_data.version}"
-                    f" -> {remote_data.version}。")
-        else:
-            return ("当前版本与远程仓库版本一致，"
-                    f"版本均为：{remote_data.version}。")
+        if delta is not None:
+            return (f"完成版本更新：{local_version}"
+                    f" -> {remote_data.version}（{delta}）。")
+        return (f"完成版本更新：{local_version}"
+                f" -> {remote_data.version}。")
 
     except requests.RequestException as e:
         print(f"请求出错: {e}")
         return "更新失败：请求出错"
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, KeyError, ValueError):
         print("解析 JSON 出错")
         return "更新失败：解析 JSON 出错"
 
 
+_update_lock: asyncio.Lock | None = None
+
+
+async def update_metro_data_async(url=metro_data_url):
+    """
+    在线程池里执行 `update_metro_data`, 不阻塞事件循环
+
+    新地图构建完成前, 查询继续使用当前的版本; 同时只进行一次更新
+    """
+    global _update_lock
+    if _update_lock is None:
+        _update_lock = asyncio.Lock()
+    async with _update_lock:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, update_metro_data, url)
+
+
+def start_auto_update(
+    interval: float | None = None,
+    url=metro_data_url,
+) -> threading.Thread | None:
+    """
+    启动后台线程, 立即检查一次更新, 之后每隔 `interval`
+    (默认 `AUTO_UPDATE_INTERVAL`) 秒检查一次; 间隔为 `None` 时不启动
+    """
+    global _auto_update_stop
+    if interval is None:
+        interval = AUTO_UPDATE_INTERVAL
+    if interval is None:
+        return None
+    stop_auto_update()
+    stop = _auto_update_stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            try:
+                update_metro_data(url)
+            except Exception:
+                logger.exception("Background metro data update failed")
+            stop.wait(interval)
+
+    thread = threading.Thread(
+        target=run, name="metro-auto-update", daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_auto_update():
+    global _auto_update_stop
+    if _auto_update_stop is not None:
+        _auto_update_stop.set()
+        _auto_update_stop = None
+
+
+async def list_stations_async() -> str:
+    """
+    在线程池里执行 `list_stations`; 第一次调用时可能要读取甚至下载地图
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, list_stations)
+
+
 def list_stations() -> str:
-    global MAP
-    if MAP is None:
+    metro_map = get_map()
+    if metro_map is None:
         return "No metro map loaded"
 
     enabled_stations = [
         str(station.name)
-        for station in MAP.stations.values()
+        for station in metro_map.stations.values()
         if station.status == "enabled"
     ]
     disabled_stations = [
         str(station.name)
-        for station in MAP.stations.values()
+        for station in metro_map.stations.values()
         if station.status == "disabled"
     ]
 
@@ -103,10 +479,5 @@ def list_stations() -> str:
     return res
 
 
-
-update_metro_data(metro_data_url)
 if os.path.exists(tmp_file_path):
     os.remove(tmp_file_path)
-
-
-logger = logging.getLogger(__name__)
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-import heapq
+from dataclasses import dataclass, field
 from logging import getLogger
+import pickle
 from typing import Any, Callable, List, Literal, Dict, Tuple
 
+from .fuzzymatching import MATCH_THRESHOLD, StationNameIndex
+from .graph import CompiledGraph, LineGraph, PathTable
+from .spatial import GridIndex, StationArray, np
+
 L10N_LANG = "zh"
 
 
@@ -122,6 +126,8 @@ class Station:
 
 StationBank = Dict[str, Station]
 """id as key, station as value"""
+Endpoint = Station | Coord2D | Tuple[Number, Number]
+"""批量寻路的端点: 站点, 或吸附到最近站点的坐标"""
 
 
 @dataclass
@@ -137,6 +143,167 @@ class Line:
     路线
     """
     name: L10nDict
+    sequence: List[str] = field(default_factory=list)
+    """按顺序排列的站点 id, 可能有重复"""
+    circular: bool = False
+    _position: Dict[str, List[int]] | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _directions: Dict[Tuple[str, str], str] | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _tail_directions: Dict[Tuple[str, str], str] | None = field(
+        default=None, init=False, repr=False, compare=False)
+
+    @property
+    def position(self) -> Dict[str, List[int]]:
+        """
+        站点 id -> 在 `sequence` 中的位置
+        """
+        if self._position is None:
+            position: Dict[str, List[int]] = {}
+            for i, id in enumerate(self.sequence):
+                position.setdefault(id, []).append(i)
+            self._position = position
+        return self._position
+
+    def adjacent(self, start: Station, end: Station) -> bool:
+        """
+        两站在线路上是否相邻, 环线首尾相邻
+        """
+        position = self.position
+        if start.id not in position or end.id not in position:
+            return False
+        last = len(self.sequence) - 1
+        for i in position[start.id]:
+            for j in position[end.id]:
+                if abs(i - j) == 1:
+                    return True
+                if self.circular and {i, j} == {0, last}:
+                    return True
+        return False
+
+    @property
+    def directions(self) -> Dict[Tuple[str, str], str]:
+        """
+        环线: 有向边 `(id1, id2)` -> 从这条边出发的方向名
+
+        环线上 `find_dir` 的结果只取决于一段路程的第一条边
+        """
+        if self._directions is None:
+            self._directions, self._tail_directions = self.build_directions()
+        return self._directions
+
+    @property
+    def tail_directions(self) -> Dict[Tuple[str, str], str]:
+        """
+        无环的部分 (直线和分叉线): 有向边 `(id1, id2)` -> 经过这条边后的方向名
+
+        树上 `find_dir` 的结果只取决于一段路程的最后一条边:
+        去掉这条边后前方的所有端点
+        """
+        if self._tail_directions is None:
+            self._directions, self._tail_directions = self.build_directions()
+        return self._tail_directions
+
+    def build_directions(
+        self,
+    ) -> Tuple[Dict[Tuple[str, str], str], Dict[Tuple[str, str], str]]:
+        """
+        按连通分量预先计算 `(directions, tail_directions)`;
+        既有环又有分叉的分量不计算, 由 `direction` 退回 `find_dir`
+        """
+        graph = self.routes.routes
+        directions: Dict[Tuple[str, str], str] = {}
+        tail_directions: Dict[Tuple[str, str], str] = {}
+        visited = set()
+        for id in graph:
+            if id in visited:
+                continue
+            component = [id]
+            visited.add(id)
+            frontier = [id]
+            while frontier:
+                current = frontier.pop()
+                for neighbor in graph[current]:
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        component.append(neighbor)
+                        frontier.append(neighbor)
+            if any(node in graph[node] for node in component):
+                continue
+            edges = {
+                frozenset((node, neighbor))
+                for node in component for neighbor in graph[node]
+            }
+            symmetric = sum(len(graph[node]) for node in component) \
+                == 2 * len(edges)
+            if symmetric and len(edges) == len(component) - 1:
+                tail_directions.update(self._tree_directions(component))
+            elif symmetric and all(len(graph[node]) == 2 for node in component):
+                directions.update(self._loop_directions(component))
+        return directions, tail_directions
+
+    def _tree_directions(
+        self,
+        component: List[str],
+    ) -> Dict[Tuple[str, str], str]:
+        """
+        `(u, v)` -> 去掉 `u` 后从 `v` 能到的端点名, 顺序同 `find_dir` 的深度优先
+        """
+        graph = self.routes.routes
+        leaves: Dict[Tuple[str, str], List[str]] = {}
+        # 后序遍历, 线路很长时也不会递归过深
+        for root in component:
+            for first in graph[root]:
+                stack = [(root, first, False)]
+                while stack:
+                    u, v, expanded = stack.pop()
+                    if (u, v) in leaves:
+                        continue
+                    ahead = [w for w in graph[v] if w != u]
+                    if expanded:
+                        leaves[(u, v)] = [
+                            name for w in ahead for name in leaves[(v, w)]
+                        ] or [str(self.stations[v].name)]
+                        continue
+                    stack.append((u, v, True))
+                    stack.extend(
+                        (v, w, False) for w in ahead if (v, w) not in leaves)
+        return {edge: "/".join(names) for edge, names in leaves.items()}
+
+    def _loop_directions(
+        self,
+        component: List[str],
+    ) -> Dict[Tuple[str, str], str]:
+        """环线: 开往出发站的上一站"""
+        graph = self.routes.routes
+        order = [component[0]]
+        while len(order) < len(component):
+            for neighbor in graph[order[-1]]:
+                if neighbor not in order[-2:]:
+                    order.append(neighbor)
+                    break
+        names = [str(self.stations[node].name) for node in order]
+        n = len(order)
+        directions: Dict[Tuple[str, str], str] = {}
+        for i in range(n):
+            j = (i + 1) % n
+            directions[(order[i], order[j])] = names[i - 1]
+            directions[(order[j], order[i])] = names[(i + 2) % n]
+        return directions
+
+    def direction(self, *stations: Station) -> str:
+        """
+        `stations` 这一段的行驶方向, 等价于 `find_dir`
+        """
+        if len(stations) >= 2 and stations[0] != stations[-1]:
+            direction = self.tail_directions.get(
+                (stations[-2].id, stations[-1].id))
+            if direction is None:
+                direction = self.directions.get(
+                    (stations[0].id, stations[1].id))
+            if direction is not None:
+                return direction
+        return self.find_dir(*stations)
 
     def find_dir(
         self,
@@ -198,15 +365,21 @@ class Line:
         判断 `stations` (按顺序) 是否在这条线上
         """
 
-        last = None
-        for station in stations:
-            if station.id not in self.stations:
-                return False
-            if last is not None:
-                if self.routes.get_weight(last, station) is None:
+        if len(self.sequence) == 0:
+            # 没有站点序列时直接查图
+            last = None
+            for station in stations:
+                if station.id not in self.stations:
                     return False
-            last = station
-        return True
+                if last is not None:
+                    if self.routes.get_weight(last, station) is None:
+                        return False
+                last = station
+            return True
+        if len(stations) == 1:
+            return stations[0].id in self.position
+        return all(
+            self.adjacent(a, b) for a, b in zip(stations, stations[1:]))
 
     @classmethod
     def deserialize(
@@ -219,34 +392,52 @@ class Line:
             raise NotImplementedError("Format version 1 is not supported")
         elif format_version == 2:
             id, line = data
-            for id in line["stations"]:
-                if id not in all_stations:
-                    logger.warning(f"Station `{id}` not found in global bank")
-            stations = {
-                id: all_stations[id]
-                for id in line["stations"]
-                if id in all_stations
-            }
-
+            for station_id in line["stations"]:
+                if station_id not in all_stations:
+                    logger.warning(
+                        f"Station `{station_id}` not found in global bank")
             circular = line.get("circle", False)
             if type(circular) is str:
                 circular = circular.lower() in ["true", "yes", "1"]
-            routes = cls.routes_from_list(
-                stations=[
-                    stations[id]
-                    for id in line["stations"]
-                    if id in stations
-                ],
-                circular=circular,
-            )
-            return cls(
+            return cls.from_sequence(
                 id=id,
-                stations=stations,
-                routes=routes,
-                name=L10nDict.from_dict(line["name"])
+                name=L10nDict.from_dict(line["name"]),
+                sequence=[
+                    station_id
+                    for station_id in line["stations"]
+                    if station_id in all_stations
+                ],
+                circular=bool(circular),
+                all_stations=all_stations,
             )
         raise ValueError(f"Invalid format version `{format_version}`")
 
+    @classmethod
+    def from_sequence(
+        cls,
+        id: str,
+        name: L10nDict,
+        sequence: List[str],
+        circular: bool,
+        all_stations: StationBank,
+    ) -> Line:
+        """
+        按站点顺序构建线路, `sequence` 中的站点都须在 `all_stations` 中
+        """
+        stations = {station_id: all_stations[station_id]
+                    for station_id in sequence}
+        return cls(
+            id=id,
+            stations=stations,
+            routes=cls.routes_from_list(
+                stations=[stations[station_id] for station_id in sequence],
+                circular=circular,
+            ),
+            name=name,
+            sequence=list(sequence),
+            circular=circular,
+        )
+
     @classmethod
     def routes_from_list(
         cls,
@@ -314,21 +505,47 @@ class NaviGraph:
     """`table[id1][id2]` 为 1 到 2 的 weight"""
     nodes: StationBank
     """`id`: `station`"""
+    _compiled: CompiledGraph | None = field(
+        default=None, init=False, repr=False, compare=False)
+
+    @property
+    def compiled(self) -> CompiledGraph:
+        """
+        整数索引的紧凑表示, 寻路在它上面进行, 修改图后自动重建
+        """
+        if self._compiled is None:
+            self._compiled = CompiledGraph.from_navi_graph(self)
+        return self._compiled
 
     def __add__(self, other: NaviGraph) -> NaviGraph:
         """
-        Merge two graphs, the latter one will overwrite the former one
+        Merge two graphs, existing weights of the former one are kept
         TODO: min weight
+
+        两个操作数都不会被修改
         """
-        nodes = {**self.nodes, **other.nodes}
-        routes = {**self.routes}
+        graph = NaviGraph(
+            routes={id: dict(table) for id, table in self.routes.items()},
+            nodes={**self.nodes},
+        )
+        graph.merge(other)
+        return graph
+
+    def merge(self, other: NaviGraph):
+        """
+        原地合并 `other`, 已有的 weight 不会被覆盖
+
+        `other` 的内层字典不会被引用, 之后修改 `self` 不影响 `other`
+        """
+        self._compiled = None
+        self.nodes.update(other.nodes)
         for id1, table in other.routes.items():
-            if id1 not in routes:
-                routes[id1] = {}
+            if id1 not in self.routes:
+                self.routes[id1] = {}
+            own = self.routes[id1]
             for id2, weight in table.items():
-                if id2 not in routes[id1]:
-                    routes[id1][id2] = weight
-        return NaviGraph(routes=routes, nodes=nodes)
+                if id2 not in own:
+                    own[id2] = weight
 
     def add_route(
         self,
@@ -340,6 +557,7 @@ class NaviGraph:
         """
         添加路径
         """
+        self._compiled = None
         if start.id not in self.routes:
             self.routes[start.id] = {}
         self.routes[start.id][end.id] = weight
@@ -361,54 +579,189 @@ class NaviGraph:
         start: Station,
         end: Station,
         heuristic_weight: float = 1.0,
-        h_func: Callable[[Station, Station],
-                         float] = lambda x, y: x.distance_to(y)
+        h_func: Callable[[Station, Station], float] | None = None,
+        bidirectional: bool = False,
     ) -> Tuple[List[Station], float]:
         """
         寻找最短路径, 既然是地铁站那用 astar 吧
 
-        启发函数: 两点间的曼哈顿距离
+        启发函数: 默认为两点间的曼哈顿距离,
+        `bidirectional` 时从两端同时搜索, 不支持自定义 `h_func`
         """
-        came_from: Dict[Station, Station] = {}
+        graph = self.compiled
+        start_node, end_node = graph.index[start.id], graph.index[end.id]
+        if bidirectional:
+            if h_func is not None:
+                raise ValueError("h_func is not supported in bidirectional mode")
+            path, distance = graph.bidirectional_astar(
+                start_node, end_node, heuristic_weight=heuristic_weight)
+        else:
+            h = None
+            if h_func is not None:
+                def h(node: int) -> float:
+                    return h_func(self.nodes[graph.ids[node]], end)
+            path, distance = graph.astar(
+                start_node, end_node, heuristic_weight=heuristic_weight, h=h)
+        if len(path) == 0:
+            logger.warning("No route found")
+            return [], distance
+        return [self.nodes[graph.ids[node]] for node in path], distance
 
-        def construct_path(last: Station) -> List[Station]:
-            res = []
-            current = last
-            while current != start:
-                res.append(current)
-                current = came_from[current]
-            res.append(start)
-            return res[::-1]
-
-        g_score: Dict[Station, float] = {
-            station: float("inf")
-            for station in self.nodes.values()
-        }
-        g_score[start] = 0
-        f_score: Dict[Station, float] = {
-            station: float("inf")
-            for station in self.nodes.values()
-        }
-        f_score[start] = h_func(start, end)
-        open_set = [(f_score[start], start)]
-        while len(open_set) > 0:
-            current = heapq.heappop(open_set)
-            if current[1] == end:
-                return construct_path(current[1]), g_score[end]
-
-            for neighbor_id in self.routes[current[1].id]:
-                neighbor = self.nodes[neighbor_id]
-                tentative_g_score = g_score[current[1]] + \
-                    self.get_weight(current[1], neighbor)  # type: ignore
-                if tentative_g_score < g_score[neighbor]:
-                    came_from[neighbor] = current[1]
-                    g_score[neighbor] = tentative_g_score
-                    f_score[neighbor] = g_score[neighbor] + \
-                        heuristic_weight * h_func(neighbor, end)
-                    heapq.heappush(open_set, (f_score[neighbor], neighbor))
-
-        logger.warning("No route found")
-        return [], float("inf")
+
+@dataclass
+class Leg:
+    """
+    路线中在同一条线上的一段
+    """
+    line: Line
+    direction: str
+    stations: List[Station]
+    """上车站到下车站, 含两端"""
+    distance: float
+
+    @property
+    def stop_count(self) -> int:
+        return len(self.stations) - 1
+
+    @classmethod
+    def on_line(cls, line: Line, stations: List[Station]) -> Leg:
+        routes = line.routes.routes
+        return cls(
+            line=line,
+            direction=line.direction(*stations),
+            stations=stations,
+            distance=sum(
+                routes[a.id][b.id] for a, b in zip(stations, stations[1:])),
+        )
+
+    @property
+    def board(self) -> Station:
+        return self.stations[0]
+
+    @property
+    def alight(self) -> Station:
+        return self.stations[-1]
+
+
+@dataclass
+class Itinerary:
+    """
+    一次导航的结果
+    """
+    legs: List[Leg]
+    distance: float
+    """乘车距离"""
+    start_station: Station | None
+    end_station: Station | None
+    start_walk: float
+    end_walk: float
+
+    @property
+    def stations(self) -> List[Station]:
+        if len(self.legs) == 0:
+            return [] if self.start_station is None else [self.start_station]
+        res = [self.legs[0].board]
+        for leg in self.legs:
+            res.extend(leg.stations[1:])
+        return res
+
+    @classmethod
+    def empty(cls) -> Itinerary:
+        inf = float("inf")
+        return cls([], inf, None, None, inf, inf)
+
+
+@dataclass
+class RouteMatrix:
+    """
+    批量寻路的结果, `distances[i][j]` 为第 i 个起点到第 j 个终点的乘车距离
+
+    与 `plan_route` 相同, 每对起终点在各自的候选站点中选步行加乘车代价最小的
+    """
+    sources: List[List[Tuple[Station, float]]]
+    """每个起点的候选站点及步行距离, 站点本身只有一个候选, 没有站点时为空"""
+    targets: List[List[Tuple[Station, float]]]
+    distances: List[List[float]]
+    """不可达为 `inf`"""
+    starts: List[List[Tuple[Station | None, float]]]
+    """`starts[i][j]` 为选中的起点站及步行距离, 不可达时为 `(None, inf)`"""
+    ends: List[List[Tuple[Station | None, float]]]
+    paths: List[List[List[Station]]] | None = None
+    """`paths[i][j]` 为站点路径, 不可达为空; 只在需要时生成"""
+
+    def total(self, i: int, j: int) -> float:
+        """步行加乘车的总距离"""
+        return self.starts[i][j][1] + self.distances[i][j] + self.ends[i][j][1]
+
+
+@dataclass
+class MapDelta:
+    """
+    两个版本地图之间的差异, 按 id 比较站点和线路
+    """
+    version: MapVersion
+    """新版本"""
+    added_stations: Dict[str, Station] = field(default_factory=dict)
+    changed_stations: Dict[str, Station] = field(default_factory=dict)
+    """id -> 新的站点数据 (坐标, 站名或状态有变化)"""
+    removed_stations: List[str] = field(default_factory=list)
+    added_lines: Dict[str, Line] = field(default_factory=dict)
+    changed_lines: Dict[str, Line] = field(default_factory=dict)
+    """id -> 新的线路 (站名, 站点顺序或是否环线有变化)"""
+    removed_lines: List[str] = field(default_factory=list)
+
+    @classmethod
+    def between(cls, old: MetroMap, new: MetroMap) -> MapDelta:
+        """
+        `new` 只用到站点和线路数据, 不需要 `compile`
+        """
+        if old.version.format_ver != 2 or new.version.format_ver != 2:
+            raise ValueError("Delta updates need format version 2")
+        delta = cls(version=new.version)
+        for id, station in new.stations.items():
+            current = old.stations.get(id)
+            if current is None:
+                delta.added_stations[id] = station
+            elif (
+                (current.location, current.name, current.status)
+                != (station.location, station.name, station.status)
+            ):
+                delta.changed_stations[id] = station
+        delta.removed_stations = [
+            id for id in old.stations if id not in new.stations]
+        for id, line in new.lines.items():
+            current = old.lines.get(id)
+            if current is None:
+                delta.added_lines[id] = line
+            elif (
+                (current.name, current.sequence, current.circular)
+                != (line.name, line.sequence, line.circular)
+            ):
+                delta.changed_lines[id] = line
+        delta.removed_lines = [id for id in old.lines if id not in new.lines]
+        return delta
+
+    def __len__(self) -> int:
+        return (
+            len(self.added_stations) + len(self.changed_stations)
+            + len(self.removed_stations) + len(self.added_lines)
+            + len(self.changed_lines) + len(self.removed_lines)
+        )
+
+    def __str__(self) -> str:
+        parts = [
+            f"{action}{kind} {count} {unit}"
+            for action, kind, unit, count in (
+                ("新增", "站点", "个", len(self.added_stations)),
+                ("修改", "站点", "个", len(self.changed_stations)),
+                ("删除", "站点", "个", len(self.removed_stations)),
+                ("新增", "线路", "条", len(self.added_lines)),
+                ("修改", "线路", "条", len(self.changed_lines)),
+                ("删除", "线路", "条", len(self.removed_lines)),
+            )
+            if count > 0
+        ]
+        return "、".join(parts) if parts else "无变化"
 
 
 @dataclass
@@ -419,18 +772,559 @@ class MetroMap:
     version: MapVersion
     stations: StationBank
     lines: Dict[str, Line]
+    _navi_graph: NaviGraph | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _spatial_index: GridIndex | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _station_array: StationArray | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _name_index: StationNameIndex | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _edge_lines: Dict[Tuple[str, str], List[str]] | None = field(
+        default=None, init=False, repr=False, compare=False)
+    _line_graph: LineGraph | None = field(
+        default=None, init=False, repr=False, compare=False)
+    path_table: PathTable | None = field(
+        default=None, init=False, repr=False, compare=False)
+    """可选的全源最短路表, 存在时 `find_route` 直接查表"""
 
     @property
-    def navi_graph(self):
+    def navi_graph(self) -> NaviGraph:
+        """
+        导航图, 合并所有线路, 构建一次后缓存
+
+        修改 `stations` / `lines` 后需要调用 `invalidate`
+        """
+        if self._navi_graph is None:
+            self._navi_graph = self.build_navi_graph()
+        return self._navi_graph
+
+    def build_navi_graph(self) -> NaviGraph:
         """
-        导航图
+        合并所有线路的导航图, 不修改各线路自己的 `routes`
         """
-        nodes = self.stations
-        graph = NaviGraph(routes={}, nodes=nodes)
+        graph = NaviGraph(routes={}, nodes={**self.stations})
         for line in self.lines.values():
-            graph = graph + line.routes
+            graph.merge(line.routes)
         return graph
 
+    @property
+    def edge_lines(self) -> Dict[Tuple[str, str], List[str]]:
+        """
+        `(id1, id2)` -> 经过这条边的线路 id, 按 `lines` 的顺序
+        """
+        if self._edge_lines is None:
+            edge_lines: Dict[Tuple[str, str], List[str]] = {}
+            for line_id, line in self.lines.items():
+                for id1, table in line.routes.routes.items():
+                    for id2 in table:
+                        edge_lines.setdefault((id1, id2), []).append(line_id)
+            self._edge_lines = edge_lines
+        return self._edge_lines
+
+    def segment_route(
+        self,
+        route: List[Station],
+    ) -> List[Tuple[Line, List[Station]]]:
+        """
+        把路径拆成若干段, 每段尽量长地留在同一条线上
+
+        一次遍历: 维护能覆盖当前段所有边的线路, 为空时断开,
+        取其中 `lines` 顺序最靠前的一条
+        """
+        edge_lines = self.edge_lines
+        legs: List[Tuple[Line, List[Station]]] = []
+        start = 0
+        candidates: List[str] = []
+        for i in range(len(route) - 1):
+            on_edge = edge_lines.get((route[i].id, route[i + 1].id), [])
+            remaining = [id for id in candidates if id in on_edge]
+            if i > start and len(remaining) == 0:
+                legs.append((self.lines[candidates[0]], route[start:i + 1]))
+                start = i
+                remaining = list(on_edge)
+            elif i == start:
+                remaining = list(on_edge)
+            if len(remaining) == 0:
+                raise ValueError(
+                    f"No line between `{route[i].id}` and `{route[i + 1].id}`")
+            candidates = remaining
+        if len(route) > 1:
+            legs.append((self.lines[candidates[0]], route[start:]))
+        return legs
+
+    def legs_of(self, route: List[Station]) -> List[Leg]:
+        """
+        把站点路径拆成带方向的 `Leg`
+        """
+        return [
+            Leg.on_line(line, stations)
+            for line, stations in self.segment_route(route)
+        ]
+
+    @property
+    def line_graph(self) -> LineGraph:
+        """
+        `(站点, 线路)` 状态图
+        """
+        if self._line_graph is None:
+            self._line_graph = LineGraph.from_metro_map(self)
+        return self._line_graph
+
+    def plan_route(
+        self,
+        sources: List[Tuple[Station, float]],
+        targets: List[Tuple[Station, float]],
+        walk_weight: float = 1.0,
+        transfer_cost: float = 0.0,
+        line_aware: bool = False,
+    ) -> Itinerary:
+        """
+        寻路并拆分成带线路和方向的各段
+
+        参数同 `find_route_multi`; 默认在导航图上 A* 后用 `segment_route` 拆分,
+        `line_aware` 或 `transfer_cost` 大于 0 时改为在 `(站点, 线路)`
+        状态图上搜索, 每次换乘额外计 `transfer_cost`, 代价相同时换乘少的优先
+        (约慢 2~3 倍); 有 `path_table` 时总是查表再拆分
+        """
+        if self.path_table is not None or not (
+                line_aware or transfer_cost > 0):
+            route, distance, start_walk, end_walk = self.find_route_multi(
+                sources, targets, walk_weight=walk_weight)
+            if len(route) == 0:
+                return Itinerary.empty()
+            return Itinerary(
+                legs=self.legs_of(route),
+                distance=distance,
+                start_station=route[0],
+                end_station=route[-1],
+                start_walk=start_walk,
+                end_walk=end_walk,
+            )
+        graph = self.line_graph
+        walk_from = {
+            graph.station_index[station.id]: distance
+            for station, distance in sources
+        }
+        walk_to = {
+            graph.station_index[station.id]: distance
+            for station, distance in targets
+        }
+        path, cost = graph.search(
+            {node: walk_weight * d for node, d in walk_from.items()},
+            {node: walk_weight * d for node, d in walk_to.items()},
+            transfer_cost=transfer_cost,
+        )
+        # 不在任何线路上的站点没有状态, 单独考虑从同一站进出
+        shared = min(
+            (
+                (walk_weight * (walk_from[node] + walk_to[node]), node)
+                for node in walk_from.keys() & walk_to.keys()
+            ),
+            default=(float("inf"), -1),
+        )
+        if shared[0] < cost:
+            station = self.stations[graph.station_ids[shared[1]]]
+            return Itinerary(
+                [], 0, station, station,
+                walk_from[shared[1]], walk_to[shared[1]],
+            )
+        if len(path) == 0:
+            logger.warning("No route found")
+            return Itinerary.empty()
+        stations = [
+            self.stations[graph.station_ids[graph.state_station[state]]]
+            for state in path
+        ]
+        lines = [graph.line_ids[graph.state_line[state]] for state in path]
+        legs: List[Leg] = []
+        start = 0
+        for i in range(1, len(path) + 1):
+            if i < len(path) and lines[i] == lines[start]:
+                continue
+            if i - start > 1:
+                legs.append(
+                    Leg.on_line(self.lines[lines[start]], stations[start:i]))
+            start = i
+        return Itinerary(
+            legs=legs,
+            distance=sum(leg.distance for leg in legs),
+            start_station=stations[0],
+            end_station=stations[-1],
+            start_walk=walk_from[graph.state_station[path[0]]],
+            end_walk=walk_to[graph.state_station[path[-1]]],
+        )
+
+    def build_path_table(self) -> PathTable:
+        """
+        构建全源最短路表并挂到 `path_table` 上
+        """
+        self.path_table = PathTable.build(
+            self.navi_graph.compiled, str(self.version))
+        return self.path_table
+
+    def find_route(
+        self,
+        start: Station,
+        end: Station,
+    ) -> Tuple[List[Station], float]:
+        """
+        有 `path_table` 时查表, 否则在导航图上 A*
+        """
+        graph = self.navi_graph
+        table = self.path_table
+        if table is None:
+            return graph.find_route(start, end)
+        compiled = graph.compiled
+        path, distance = table.lookup(
+            compiled.index[start.id], compiled.index[end.id])
+        if len(path) == 0:
+            logger.warning("No route found")
+        return [graph.nodes[compiled.ids[node]] for node in path], distance
+
+    def find_route_multi(
+        self,
+        sources: List[Tuple[Station, float]],
+        targets: List[Tuple[Station, float]],
+        walk_weight: float = 1.0,
+    ) -> Tuple[List[Station], float, float, float]:
+        """
+        从若干候选起点到若干候选终点的最优路线, 一次搜索完成
+
+        `sources` / `targets` 为 `(站点, 步行距离)`, 步行距离乘以
+        `walk_weight` 后作为虚拟边计入代价
+
+        返回 `(路径, 乘车距离, 起点步行距离, 终点步行距离)`,
+        无路线时路径为空, 距离为 `inf`
+        """
+        graph = self.navi_graph
+        compiled = graph.compiled
+        walk_from = {
+            compiled.index[station.id]: distance
+            for station, distance in sources
+        }
+        walk_to = {
+            compiled.index[station.id]: distance
+            for station, distance in targets
+        }
+        table = self.path_table
+        if table is None:
+            path, _ = compiled.multi_source_route(
+                {node: walk_weight * d for node, d in walk_from.items()},
+                {node: walk_weight * d for node, d in walk_to.items()},
+            )
+        else:
+            path, best = [], float("inf")
+            for source, start_walk in walk_from.items():
+                for target, end_walk in walk_to.items():
+                    candidate, distance = table.lookup(source, target)
+                    cost = distance + walk_weight * (start_walk + end_walk)
+                    if len(candidate) > 0 and cost < best:
+                        path, best = candidate, cost
+        if len(path) == 0:
+            logger.warning("No route found")
+            return [], float("inf"), float("inf"), float("inf")
+        stations = [graph.nodes[compiled.ids[node]] for node in path]
+        distance = sum(
+            graph.routes[a.id][b.id] for a, b in zip(stations, stations[1:]))
+        return stations, distance, walk_from[path[0]], walk_to[path[-1]]
+
+    def snap_endpoints(
+        self,
+        endpoints: List[Endpoint],
+        k: int = 1,
+    ) -> List[List[Tuple[Station, float]]]:
+        """
+        每个端点的候选站点及步行距离: 站点为它自己, 坐标为最近的 `k` 个站点;
+        相同的坐标只查询一次, 所有坐标一起查询 (`find_nearest_stations_many`)
+        """
+        points: Dict[Tuple[Number, Number], List[Tuple[Station, float]]] = {}
+        for endpoint in endpoints:
+            if isinstance(endpoint, Coord2D):
+                points[(endpoint.x, endpoint.z)] = []
+            elif not isinstance(endpoint, Station):
+                points[tuple(endpoint)] = []
+        nearest = self.find_nearest_stations_many(list(points), k)
+        for point, found in zip(points, nearest):
+            points[point] = found
+        return [
+            [(endpoint, 0.0)] if isinstance(endpoint, Station)
+            else points[(endpoint.x, endpoint.z)]
+            if isinstance(endpoint, Coord2D) else points[tuple(endpoint)]
+            for endpoint in endpoints
+        ]
+
+    def route_matrix(
+        self,
+        sources: List[Endpoint],
+        targets: List[Endpoint],
+        paths: bool = False,
+        candidates: int = 1,
+        walk_weight: float = 1.0,
+    ) -> RouteMatrix:
+        """
+        所有起点到所有终点的乘车距离, `paths` 为 True 时同时给出路径
+
+        坐标吸附到最近的 `candidates` 个站点, 每对起终点取
+        `walk_weight * 步行距离 + 乘车距离` 最小的一组站点, 同 `find_route_multi`;
+        每个不同的候选起点站只求一棵最短路树 (有 `path_table` 时直接取表中的一行)
+        """
+        graph = self.navi_graph
+        compiled = graph.compiled
+        table = self.path_table
+        snapped_sources = self.snap_endpoints(sources, candidates)
+        snapped_targets = self.snap_endpoints(targets, candidates)
+        target_nodes = [
+            [(compiled.index[station.id], walk) for station, walk in found]
+            for found in snapped_targets
+        ]
+        trees: Dict[int, Tuple[Any, Any]] = {}
+
+        def tree(source: int) -> Tuple[Any, Any]:
+            if source not in trees:
+                trees[source] = table.row(source) if table is not None \
+                    else compiled.dijkstra(source)
+            return trees[source]
+
+        distances: List[List[float]] = []
+        starts: List[List[Tuple[Station | None, float]]] = []
+        ends: List[List[Tuple[Station | None, float]]] = []
+        all_paths: List[List[List[Station]]] = []
+        inf = float("inf")
+        for found in snapped_sources:
+            roots = [
+                (source, walk, tree(source))
+                for source, walk in (
+                    (compiled.index[station.id], walk)
+                    for station, walk in found)
+            ]
+            distance_row, start_row, end_row, path_row = [], [], [], []
+            for options in target_nodes:
+                # (代价, 乘车距离, 起点, 起点步行, 终点, 终点步行, 前驱)
+                best = (inf, inf, -1, inf, -1, inf, None)
+                for source, start_walk, (dist, pred) in roots:
+                    for target, end_walk in options:
+                        cost = dist[target] + walk_weight * (start_walk + end_walk)
+                        if cost < best[0]:
+                            best = (cost, dist[target], source, start_walk,
+                                    target, end_walk, pred)
+                _, ride, source, start_walk, target, end_walk, pred = best
+                distance_row.append(ride)
+                if pred is None:
+                    start_row.append((None, inf))
+                    end_row.append((None, inf))
+                    path_row.append([])
+                    continue
+                start_row.append(
+                    (graph.nodes[compiled.ids[source]], start_walk))
+                end_row.append((graph.nodes[compiled.ids[target]], end_walk))
+                if paths:
+                    path_row.append([
+                        graph.nodes[compiled.ids[node]]
+                        for node in compiled.construct_path(pred, source, target)
+                    ])
+            distances.append(distance_row)
+            starts.append(start_row)
+            ends.append(end_row)
+            all_paths.append(path_row)
+        return RouteMatrix(
+            sources=snapped_sources,
+            targets=snapped_targets,
+            distances=distances,
+            starts=starts,
+            ends=ends,
+            paths=all_paths if paths else None,
+        )
+
+    def compile(self) -> MetroMap:
+        """
+        预先构建所有派生结构 (导航图等), 返回自身
+        """
+        self.navi_graph.compiled
+        self.spatial_index
+        self.name_index
+        self.edge_lines
+        self.line_graph
+        for line in self.lines.values():
+            line.position
+            line.directions
+        return self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        最短路表单独保存, NumPy 数组用到时再建, 都不随 pickle 复制
+        """
+        state = self.__dict__.copy()
+        state["path_table"] = None
+        state["_station_array"] = None
+        return state
+
+    def clone(self) -> MetroMap:
+        """
+        深拷贝, 连同已构建的派生结构; 比 `from_dict` 重新构建快得多,
+        用于在副本上应用 `apply_delta`, 不影响正在使用的地图
+        """
+        return pickle.loads(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def apply_delta(self, delta: MapDelta) -> MetroMap:
+        """
+        原地应用 `delta`, 返回自身
+
+        只修补受影响的站点和线路, 以及已构建的导航图, 线路表,
+        网格索引和站名索引; 整数索引的导航图和线路状态图由
+        `compile` 重新生成, 最短路表需要重新构建
+        """
+        navi_graph = self._navi_graph
+        edge_lines = self.edge_lines if navi_graph is not None \
+            else self._edge_lines
+        spatial_index = self._spatial_index
+        name_index = self._name_index
+
+        # 含有修改或删除的站点的线路, 方向名和距离都可能变化, 一并重建
+        touched_stations = delta.changed_stations.keys() \
+            | set(delta.removed_stations)
+        rebuild = {
+            id: delta.changed_lines.get(id, line)
+            for id, line in self.lines.items()
+            if id not in delta.removed_lines and (
+                id in delta.changed_lines
+                or not touched_stations.isdisjoint(line.stations)
+            )
+        }
+        affected = rebuild.keys() | set(delta.removed_lines)
+        touched_edges = set()
+        if edge_lines is not None:
+            for id in affected:
+                for id1, table in self.lines[id].routes.routes.items():
+                    for id2 in table:
+                        touched_edges.add((id1, id2))
+                        edge_lines[(id1, id2)].remove(id)
+
+        # 站点: 修改的原地更新, 线路和索引中的引用保持有效
+        for id in delta.removed_stations:
+            station = self.stations.pop(id)
+            if navi_graph is not None:
+                navi_graph.nodes.pop(id, None)
+            if spatial_index is not None:
+                spatial_index.remove(station)
+            if name_index is not None:
+                name_index.remove(id)
+        for id, new in delta.changed_stations.items():
+            station = self.stations[id]
+            moved = station.location != new.location
+            station.location = new.location
+            station.name = new.name
+            station.status = new.status
+            if spatial_index is not None and moved:
+                spatial_index.insert(station)
+            if name_index is not None:
+                name_index.add(station, L10N_LANG)
+        for id, station in delta.added_stations.items():
+            self.stations[id] = station
+            if navi_graph is not None:
+                navi_graph.nodes[id] = station
+            if spatial_index is not None:
+                spatial_index.insert(station)
+            if name_index is not None:
+                name_index.add(station, L10N_LANG)
+
+        # 线路: 修改的保留原来的顺序, 新增的排在最后
+        for id in delta.removed_lines:
+            del self.lines[id]
+        for id, line in [*rebuild.items(), *delta.added_lines.items()]:
+            self.lines[id] = Line.from_sequence(
+                id=id,
+                name=line.name,
+                sequence=[station_id for station_id in line.sequence
+                          if station_id in self.stations],
+                circular=line.circular,
+                all_stations=self.stations,
+            )
+        if edge_lines is not None:
+            order = {id: i for i, id in enumerate(self.lines)}
+            for id in [*rebuild, *delta.added_lines]:
+                for id1, table in self.lines[id].routes.routes.items():
+                    for id2 in table:
+                        touched_edges.add((id1, id2))
+                        on_edge = edge_lines.setdefault((id1, id2), [])
+                        on_edge.append(id)
+                        on_edge.sort(key=order.__getitem__)
+
+        # 导航图中的边取 `lines` 中第一条经过它的线路的 weight, 同 `merge`
+        for id1, id2 in touched_edges:
+            on_edge = edge_lines.get((id1, id2))
+            if on_edge:
+                weight = self.lines[on_edge[0]].routes.routes[id1][id2]
+                if navi_graph is not None:
+                    navi_graph.routes.setdefault(id1, {})[id2] = weight
+                continue
+            edge_lines.pop((id1, id2), None)
+            if navi_graph is not None and id1 in navi_graph.routes:
+                navi_graph.routes[id1].pop(id2, None)
+                if len(navi_graph.routes[id1]) == 0:
+                    del navi_graph.routes[id1]
+
+        if navi_graph is not None:
+            navi_graph._compiled = None
+        self._station_array = None
+        self._line_graph = None
+        self.path_table = None
+        self.version = delta.version
+        return self.compile()
+
+    def invalidate(self):
+        """
+        丢弃所有派生结构, 下次访问时重新构建
+        """
+        self._navi_graph = None
+        self._spatial_index = None
+        self._station_array = None
+        self._name_index = None
+        self._edge_lines = None
+        self._line_graph = None
+        self.path_table = None
+
+    @property
+    def spatial_index(self) -> GridIndex:
+        """
+        站点坐标的网格索引
+        """
+        if self._spatial_index is None:
+            self._spatial_index = GridIndex.build(self.stations.values())
+        return self._spatial_index
+
+    @property
+    def station_array(self) -> StationArray | None:
+        """
+        站点坐标的 NumPy 数组, 用于批量查询; 没有 NumPy 时为 `None`
+        """
+        if self._station_array is None and np is not None:
+            self._station_array = StationArray.build(self.stations.values())
+        return self._station_array
+
+    @property
+    def name_index(self) -> StationNameIndex:
+        """
+        站名索引 (完整站名, 拼音, 模糊匹配)
+        """
+        if self._name_index is None:
+            self._name_index = StationNameIndex.build(
+                self.stations.values(), L10N_LANG)
+        return self._name_index
+
+    def find_station_by_name(
+        self,
+        name: str,
+        threshold: float = MATCH_THRESHOLD,
+    ) -> Station | None:
+        """
+        按站名查找, 支持拼音和模糊匹配, 返回分数最高的站点
+        """
+        station_id = self.name_index.resolve(name, threshold)
+        if station_id is None:
+            return None
+        return self.stations[station_id]
+
     def find_nearest_station(
         self,
         location: Coord2D | Tuple[Number, Number],
@@ -440,24 +1334,68 @@ class MetroMap:
         """
         `filter` 留给之后筛选非匿名站点用的
         """
-        nearest = None
-        nearest_distance = float("inf")
-        for station in self.stations.values():
-            if not filter(station):
-                continue
-            if isinstance(location, tuple):
-                location = Coord2D(*location)
-            distance = location.distance_to(
-                station.location,
-                mode=distance_mode,
-            )
-            if distance < nearest_distance:
-                nearest = station
-                nearest_distance = distance
-        return nearest, nearest_distance
+        res = self.find_nearest_stations(
+            location, 1, distance_mode=distance_mode, filter=filter)
+        if len(res) == 0:
+            return None, float("inf")
+        return res[0]
+
+    def find_nearest_stations(
+        self,
+        location: Coord2D | Tuple[Number, Number],
+        k: int,
+        distance_mode: DistanceMode = "manhattan",
+        filter: Callable[[Station], bool] = lambda _: True
+    ) -> List[Tuple[Station, float]]:
+        """
+        最近的 `k` 个站点及距离, 由近到远
+        """
+        if isinstance(location, tuple):
+            location = Coord2D(*location)
+        return self.spatial_index.nearest(
+            location, k, distance_mode=distance_mode, filter=filter)
+
+    def find_nearest_stations_many(
+        self,
+        locations: List[Coord2D | Tuple[Number, Number]],
+        k: int = 1,
+        distance_mode: DistanceMode = "manhattan",
+    ) -> List[List[Tuple[Station, float]]]:
+        """
+        对每个位置查询最近的 `k` 个站点, 有 NumPy 时一次算完
+        """
+        locations = [
+            Coord2D(*location) if isinstance(location, tuple) else location
+            for location in locations
+        ]
+        array = self.station_array if len(locations) > 1 else None
+        if array is not None:
+            return array.nearest_many(locations, k, distance_mode)
+        return [
+            self.spatial_index.nearest(location, k, distance_mode)
+            for location in locations
+        ]
+
+    def find_stations_within(
+        self,
+        location: Coord2D | Tuple[Number, Number],
+        radius: float,
+        distance_mode: DistanceMode = "manhattan",
+        filter: Callable[[Station], bool] = lambda _: True
+    ) -> List[Tuple[Station, float]]:
+        """
+        距离不超过 `radius` 的站点及距离, 由近到远
+        """
+        if isinstance(location, tuple):
+            location = Coord2D(*location)
+        return self.spatial_index.within(
+            location, radius, distance_mode=distance_mode, filter=filter)
 
     @classmethod
-    def from_dict(cls, data: dict) -> MetroMap:
+    def from_dict(cls, data: dict, compile: bool = True) -> MetroMap:
+        """
+        `compile` 为 False 时只解析站点和线路, 例如只用来比较差异
+        """
         if "version" not in data:
             raise ValueError("Missing version in data")
         version = data["version"]
@@ -484,11 +1422,12 @@ class MetroMap:
                 )
                 for id in line_ids
             }
-            return cls(
+            metro_map = cls(
                 version=version,
                 stations=stations,
                 lines=lines
             )
+            return metro_map.compile() if compile else metro_map
         elif format_ver == 2:
             stations = data["stations"]
             stations = {
@@ -500,11 +1439,12 @@ class MetroMap:
                 id: Line.deserialize((id, line), format_ver, stations)
                 for id, line in lines.items()
             }
-            return cls(
+            metro_map = cls(
                 version=version,
                 stations=stations,
                 lines=lines
             )
+            return metro_map.compile() if compile else metro_map
         raise ValueError(f"Invalid format version `{format_ver}`")
 
 
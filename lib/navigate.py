@@ -1,12 +1,45 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+import io
+import itertools
+import json
 import logging
-from typing import List, Tuple
-from .metro import load_metro_data, MAP
-from .model import Coord2D, Line, MetroMap, Station
-from .fuzzymatching import fuzzy_match_integrated
+import multiprocessing
+import shlex
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Tuple
+from .holder import MapState
+from .metrics import METRICS
+from .metro import HOLDER, get_state
+from .model import (Coord2D, Endpoint, Itinerary, Leg, MetroMap, RouteMatrix,
+                    Station)
 
 
 logger = logging.getLogger(__name__)
 
+ENDPOINT_CANDIDATES = 4
+"""坐标端点考虑的最近站点个数"""
+WALK_WEIGHT = 4.0
+"""选择进出站时, 每米步行相当于多少米乘车"""
+TRANSFER_COST = 0.0
+"""每次换乘相当于多少米乘车, 大于 0 时使用区分线路的寻路"""
+LINE_AWARE_ROUTING = False
+"""为 True 时总是使用区分线路的寻路, 距离相同时换乘少的优先, 但比 A* 慢"""
+
+NAVIGATION_WORKERS = 4
+"""异步导航使用的线程数"""
+executor = ThreadPoolExecutor(
+    max_workers=NAVIGATION_WORKERS, thread_name_prefix="metro-navigate")
+
+BATCH_CHUNK = 64
+"""批量导航时每次交给工作进程的查询数"""
+
+METRICS.register_source(
+    "cache.endpoints", lambda: cache_stats().get("endpoints", {}))
+METRICS.register_source(
+    "cache.routes", lambda: cache_stats().get("routes", {}))
+
 
 def soft_float_assert(value):
     """把坐标试着转化成 float"""
@@ -20,64 +53,281 @@ def soft_float_assert(value):
 
 
 def navigate_metro(*args):
-    if MAP is None:
-        load_metro_data()
-    data = MAP
+    with METRICS.stage("navigate"):
+        return _navigate_metro(*args)
+
+
+def _navigate_metro(*args):
+    # 整个查询使用同一个版本, 期间的更新不影响它
+    state = get_state()
+    if state is None:
+        return "No metro map loaded"
+    start_candidates, end_candidates = resolve_endpoints(state, args)
+
+    if len(start_candidates) == 0:
+        return "无法找到起始站点"
+
+    if len(end_candidates) == 0:
+        return "无法找到目的站点"
+
+    return route_cached(state, start_candidates, end_candidates)[-1]
+
+
+def resolve_endpoints(
+    state: MapState,
+    args,
+) -> Tuple[List[Tuple[Station, float]], List[Tuple[Station, float]]]:
+    """
+    `navigate_metro` 的参数 -> 起点和终点的候选站点及步行距离
+
+    参数不足或站名无法匹配时抛出 `ValueError`
+    """
+    data = state.metro_map
     args = list(map(soft_float_assert, args[:]))
 
-    def take_pos(args) -> Tuple[Station | Coord2D, list]:
+    def resolve_name(name: str) -> Station | None:
+        with METRICS.stage("resolve_name"):
+            return data.find_station_by_name(name)
+
+    def nearest(x: float, z: float) -> List[Tuple[Station, float]]:
+        with METRICS.stage("nearest"):
+            return data.find_nearest_stations(
+                Coord2D(x, z), ENDPOINT_CANDIDATES)
+
+    def take_pos(args) -> Tuple[List[Tuple[Station, float]], list]:
+        """端点的候选站点及步行距离, 和剩余参数"""
         if len(args) == 0:
             raise ValueError("参数不足")
         if type(args[0]) is str:
-            # return data.stations[args[0]], args[1:]
             station_name = args[0]
-            for station_id, station in data.stations.items():
-                if (
-                    station.name["zh"] == station_name
-                    or fuzzy_match_integrated(station.name["zh"], station_name) >= 60
-                ):
-                    return data.stations[station_id], args[1:]
-            raise ValueError(f"未找到匹配的站点: {station_name}")
+            station = state.endpoints.get_or_compute(
+                station_name,
+                lambda: resolve_name(station_name),
+            )
+            if station is None:
+                raise ValueError(f"未找到匹配的站点: {station_name}")
+            return [(station, 0)], args[1:]
         if len(args) < 2:
             raise ValueError("参数不足")
-        return Coord2D(*args[:2]), args[2:]
+        x, z = args[:2]
+        if not isinstance(x, float) or not isinstance(z, float):
+            raise ValueError(f"无法识别的坐标: {x} {z}")
+        candidates = state.endpoints.get_or_compute(
+            (x, z),
+            lambda: nearest(x, z),
+        )
+        return candidates, args[2:]
 
-    start, args = take_pos(args)
-    dest, _ = take_pos(args)
+    start_candidates, args = take_pos(args)
+    end_candidates, _ = take_pos(args)
+    return start_candidates, end_candidates
 
-    if isinstance(start, Station):
-        start_station = start
-        start_distance = 0
-    else:
-        start_station, start_distance = data.find_nearest_station(start)
 
-    if isinstance(dest, Station):
-        end_station = dest
-        end_distance = 0
-    else:
-        end_station, end_distance = data.find_nearest_station(dest)
+def route_cached(
+    state: MapState,
+    start_candidates: List[Tuple[Station, float]],
+    end_candidates: List[Tuple[Station, float]],
+) -> Tuple[Itinerary, str]:
+    """带缓存的 `route_and_format`"""
+    key = (
+        tuple((station.id, d) for station, d in start_candidates),
+        tuple((station.id, d) for station, d in end_candidates),
+    )
+    return state.routes.get_or_compute(
+        key,
+        lambda: route_and_format(
+            state.metro_map, start_candidates, end_candidates),
+    )
 
-    if start_station is None:
-        return "无法找到起始站点"
 
-    if end_station is None:
-        return "无法找到目的站点"
+async def navigate_metro_async(*args):
+    """
+    在线程池中执行 `navigate_metro`, 供异步的机器人插件使用
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, navigate_metro, *args)
+
+
+def route_and_format(
+    data: MetroMap,
+    start_candidates: List[Tuple[Station, float]],
+    end_candidates: List[Tuple[Station, float]],
+) -> Tuple[Itinerary, str]:
+    """
+    返回 `(路线, 输出文本)`
+    """
+    with METRICS.stage("route"):
+        itinerary = data.plan_route(
+            start_candidates,
+            end_candidates,
+            walk_weight=WALK_WEIGHT,
+            transfer_cost=TRANSFER_COST,
+            line_aware=LINE_AWARE_ROUTING,
+        )
 
-    if start_station == end_station:
-        total_distance = start_distance + end_distance
+    if itinerary.start_station is None:
+        output = "暂无地铁乘坐方案"
+    elif len(itinerary.legs) == 0:
+        total_distance = itinerary.start_walk + itinerary.end_walk
         if total_distance <= 50:
-            return "当前位置距离目的地过近"
+            output = "当前位置距离目的地过近"
         elif total_distance >= 200000:
-            return "位置距离地铁系统过远"
+            output = "位置距离地铁系统过远"
         else:
-            return "暂无地铁乘坐方案"
+            output = "暂无地铁乘坐方案"
     else:
-        nodes, distance = data.navi_graph.find_route(start_station, end_station)
+        with METRICS.stage("format"):
+            output = format_legs_output(
+                itinerary.legs,
+                itinerary.start_walk,
+                itinerary.end_walk,
+                itinerary.distance,
+            )
+    return itinerary, output
+
 
-        formatted_output = format_route_output(
-            nodes, data, start_distance, end_distance, distance
+def parse_endpoint(state: MapState, value) -> Endpoint:
+    """站名, 或 `[x, z]` 坐标"""
+    if isinstance(value, str):
+        station = state.endpoints.get_or_compute(
+            value,
+            lambda: state.metro_map.find_station_by_name(value),
         )
-        return formatted_output
+        if station is None:
+            raise ValueError(f"未找到匹配的站点: {value}")
+        return station
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        try:
+            return Coord2D(float(value[0]), float(value[1]))
+        except (ValueError, TypeError):
+            raise ValueError(f"无法识别的坐标: {value}") from None
+    raise ValueError(f"无法识别的位置: {value}")
+
+
+def route_matrix(
+    sources: List[Any],
+    targets: List[Any] | None = None,
+    paths: bool = False,
+) -> Tuple[MetroMap, RouteMatrix]:
+    """
+    批量导航, 端点格式同 `parse_endpoint`; 不给 `targets` 时为起点两两之间
+
+    坐标端点与 `navigate_metro` 一样考虑 `ENDPOINT_CANDIDATES` 个站点
+    """
+    state = get_state()
+    if state is None:
+        raise ValueError("No metro map loaded")
+    data = state.metro_map
+    source_points = [parse_endpoint(state, value) for value in sources]
+    target_points = source_points if targets is None else [
+        parse_endpoint(state, value) for value in targets]
+    with METRICS.stage("route_matrix"):
+        matrix = data.route_matrix(
+            source_points, target_points, paths=paths,
+            candidates=ENDPOINT_CANDIDATES, walk_weight=WALK_WEIGHT)
+    return data, matrix
+
+
+def parse_batch_query(line: str) -> list:
+    """
+    批量导航的一行: 与 `--metro` 相同的空格分隔参数 (可以用引号),
+    或 JSON 数组, 元素为站名或 `[x, z]`
+    """
+    line = line.strip()
+    if not line.startswith("["):
+        return shlex.split(line)
+    values = json.loads(line)
+    if not isinstance(values, list):
+        raise ValueError(f"无法识别的查询: {line}")
+    args = []
+    for value in values:
+        if isinstance(value, list):
+            args.extend(value)
+        else:
+            args.append(value)
+    return args
+
+
+def navigate_query(state: MapState, line: str) -> Dict[str, Any]:
+    """
+    一行查询的结构化结果, 见 `itinerary_to_dict`; 失败时 `error` 为原因
+    """
+    res: Dict[str, Any] = {
+        "query": line.strip(),
+        "version": state.version,
+        "error": None,
+    }
+    # 一行出错只影响这一行的结果, 不中断整批
+    with METRICS.stage("navigate"):
+        try:
+            start_candidates, end_candidates = resolve_endpoints(
+                state, parse_batch_query(line))
+            itinerary, output = route_cached(
+                state, start_candidates, end_candidates)
+        except ValueError as e:
+            res["error"] = str(e)
+            res.update(itinerary_to_dict(Itinerary.empty()))
+            return res
+        except Exception as e:
+            logger.exception(f"Failed to navigate `{line.strip()}`")
+            res["error"] = f"{type(e).__name__}: {e}"
+            res.update(itinerary_to_dict(Itinerary.empty()))
+            return res
+    res.update(itinerary_to_dict(itinerary))
+    if len(itinerary.legs) == 0:
+        res["error"] = output
+    return res
+
+
+def _navigate_chunk(chunk: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """在工作进程中执行, 地图由 fork 继承或在进程中加载"""
+    state = get_state()
+    if state is None:
+        raise ValueError("No metro map loaded")
+    return [{"line": n, **navigate_query(state, line)} for n, line in chunk]
+
+
+def navigate_batch(
+    lines: Iterable[str],
+    workers: int = 1,
+) -> Iterator[Dict[str, Any]]:
+    """
+    逐行导航并按输入顺序产生结果, 空行和 `#` 开头的行被跳过
+
+    `workers` 大于 1 时分块交给进程池; 结果仍然是流式的,
+    同时在途的块数有上限, 不会一次读入全部输入
+    """
+    # 整批使用同一个版本
+    state = get_state()
+    if state is None:
+        raise ValueError("No metro map loaded")
+    numbered = (
+        (n, line) for n, line in enumerate(lines, 1)
+        if line.strip() != "" and not line.lstrip().startswith("#")
+    )
+    if workers <= 1:
+        for n, line in numbered:
+            yield {"line": n, **navigate_query(state, line)}
+        return
+
+    # fork 时子进程直接继承已加载的地图
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    chunks = iter(lambda: list(itertools.islice(numbered, BATCH_CHUNK)), [])
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        pending: Deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_navigate_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """当前版本的端点缓存和路线缓存的命中统计, 未加载地图时为空"""
+    state = HOLDER.current()
+    return {} if state is None else state.cache_stats()
 
 
 # 格式化输出
@@ -89,56 +339,44 @@ def format_route_output(
     start_distance,
     end_distance,
     distance,
+):
+    return format_legs_output(
+        metro_map.legs_of(route), start_distance, end_distance, distance
+    )
+
+
+def format_legs_output(
+    legs: List[Leg],
+    start_distance,
+    end_distance,
+    distance,
 ):
     output = []
-    dest = route[-1]
+    first_station = legs[0].board
+    dest = legs[-1].alight
     output.append("路线为：")
-    first_station = route[0]
     if start_distance != 0:
-        output.append(f"当前位置\n↓步行{start_distance:.2f}米\n{route[0]}地铁站 进站\n")
+        output.append(f"当前位置\n↓步行{start_distance:.2f}米\n{first_station}地铁站 进站\n")
     else:
         output.append(f"{first_station.name} 地铁站 进站\n")
 
-    route_lines: List[Tuple[Line, str, int, Station, Station]] = []
-    """line, direction, station_count, start, end"""
-
-    while len(route) > 1:
-        stataion_count = len(route) - 1
-        while True:
-            for line in metro_map.lines.values():
-                if line.include(*route[: stataion_count + 1]):
-                    direction = line.find_dir(*route[: stataion_count + 1])
-                    route_lines.append(
-                        (
-                            line,
-                            direction,
-                            stataion_count,
-                            route[0],
-                            route[stataion_count],
-                        )
-                    )
-                    logger.debug(
-                        f"{line.name}:{direction} {stataion_count} "
-                        f"{route[0].name}->{route[stataion_count].name}"
-                    )
-                    route = route[stataion_count:]
-                    break
-            else:
-                stataion_count -= 1
-                continue
-            break
-
-    for i in range(len(route_lines) - 1):
-        l, d, c, s, e = route_lines[i]
-        next_l = route_lines[i + 1][0]
+    for leg in legs:
+        logger.debug(
+            f"{leg.line.name}:{leg.direction} {leg.stop_count} "
+            f"{leg.board.name}->{leg.alight.name}"
+        )
+
+    for i in range(len(legs) - 1):
+        leg = legs[i]
+        next_l = legs[i + 1].line
         output.append(
-            f"{s.name} 地铁站 \n↓ {l.name} {d} 方向 乘坐 {c} 站\n"
-            f"{e.name} 地铁站 换乘 {next_l.name}\n"
+            f"{leg.board.name} 地铁站 \n↓ {leg.line.name} {leg.direction} 方向 乘坐 {leg.stop_count} 站\n"
+            f"{leg.alight.name} 地铁站 换乘 {next_l.name}\n"
         )
 
-    l, d, c, s, e = route_lines[-1]
+    leg = legs[-1]
     output.append(
-        f"{s.name} 地铁站 \n↓ {l.name} {d} 方向 乘坐 {c} 站\n" f"{dest.name} 地铁站\n"
+        f"{leg.board.name} 地铁站 \n↓ {leg.line.name} {leg.direction} 方向 乘坐 {leg.stop_count} 站\n" f"{dest.name} 地铁站\n"
     )
 
     if end_distance != 0:
@@ -154,3 +392,126 @@ def format_route_output(
     else:
         output.append(f"总计乘车约 {distance:.0f} 米。")
     return "\n".join(output)
+
+
+def itinerary_to_dict(itinerary: Itinerary) -> Dict[str, Any]:
+    """
+    路线的 JSON 表示, 距离单位为米, 无法到达时为 `null`
+    """
+    def endpoint(station: Station | None, walk: float):
+        if station is None:
+            return None
+        return {"station": station.id, "name": str(station.name),
+                "walk": _finite(walk)}
+    return {
+        "from": endpoint(itinerary.start_station, itinerary.start_walk),
+        "to": endpoint(itinerary.end_station, itinerary.end_walk),
+        "legs": [
+            {
+                "line": leg.line.id,
+                "line_name": str(leg.line.name),
+                "direction": str(leg.direction),
+                "board": leg.board.id,
+                "alight": leg.alight.id,
+                "stations": [station.id for station in leg.stations],
+                "distance": leg.distance,
+            }
+            for leg in itinerary.legs
+        ],
+        "ride": _finite(itinerary.distance),
+        "walk": _finite(itinerary.start_walk + itinerary.end_walk),
+    }
+
+
+def _endpoint_label(value) -> str:
+    if isinstance(value, str):
+        return value
+    return ",".join(f"{v:g}" if isinstance(v, float) else str(v)
+                    for v in value)
+
+
+def _finite(value: float) -> float | None:
+    return None if value == float("inf") else value
+
+
+def format_matrix_json(
+    matrix: RouteMatrix,
+    sources: List[Any],
+    targets: List[Any],
+    version: str = "",
+) -> str:
+    """
+    不可达的距离和选中的站点为 `null`, 路径为站点 id 列表
+    """
+    def chosen(station: Station | None, walk: float):
+        if station is None:
+            return None
+        return {"station": station.id, "name": str(station.name),
+                "walk": _finite(walk)}
+
+    def endpoints(values, snapped):
+        return [
+            {
+                "query": _endpoint_label(value),
+                "candidates": [chosen(*found) for found in candidates],
+            }
+            for value, candidates in zip(values, snapped)
+        ]
+    res = {
+        "version": version,
+        "sources": endpoints(sources, matrix.sources),
+        "targets": endpoints(targets, matrix.targets),
+        "from": [[chosen(*pair) for pair in row] for row in matrix.starts],
+        "to": [[chosen(*pair) for pair in row] for row in matrix.ends],
+        "distances": [[_finite(d) for d in row] for row in matrix.distances],
+        "totals": [
+            [_finite(matrix.total(i, j)) for j in range(len(matrix.targets))]
+            for i in range(len(matrix.sources))
+        ],
+    }
+    if matrix.paths is not None:
+        res["paths"] = [
+            [[station.id for station in path] for path in row]
+            for row in matrix.paths
+        ]
+    return json.dumps(res, ensure_ascii=False)
+
+
+def format_matrix_csv(
+    matrix: RouteMatrix,
+    sources: List[Any],
+    targets: List[Any],
+) -> str:
+    """
+    每对起终点一行, 不可达的距离为空; 有路径时站点 id 以 `>` 连接
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    header = [
+        "source", "target", "source_station", "target_station",
+        "source_walk", "ride", "target_walk", "total",
+    ]
+    if matrix.paths is not None:
+        header.append("path")
+    writer.writerow(header)
+
+    def number(value: float) -> str:
+        return "" if value == float("inf") else f"{value:.2f}"
+    for i, source in enumerate(sources):
+        for j, target in enumerate(targets):
+            start, start_walk = matrix.starts[i][j]
+            end, end_walk = matrix.ends[i][j]
+            row = [
+                _endpoint_label(source),
+                _endpoint_label(target),
+                "" if start is None else start.id,
+                "" if end is None else end.id,
+                number(start_walk),
+                number(matrix.distances[i][j]),
+                number(end_walk),
+                number(matrix.total(i, j)),
+            ]
+            if matrix.paths is not None:
+                row.append(">".join(station.id for station in matrix.paths[i][j]))
+            writer.writerow(row)
+    return buffer.getvalue()
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import heapq
+from math import floor, isfinite
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖, 没有时只用网格索引
+    np = None
+
+if TYPE_CHECKING:
+    from .model import Coord2D, DistanceMode, Station
+
+Cell = Tuple[int, int]
+
+BATCH_CHUNK = 1 << 20
+"""批量查询时一次计算的距离矩阵元素个数上限"""
+
+
+@dataclass
+class GridIndex:
+    """
+    均匀网格空间索引, 用于最近站点 / k 近邻 / 半径查询
+
+    距离相同时按插入顺序取先插入的站点, 与逐个遍历的结果一致
+    """
+    cell_size: float
+    cells: Dict[Cell, List[Tuple[int, Station]]] = field(default_factory=dict)
+    """格子 -> `(插入序号, 站点)`"""
+    bounds: Tuple[int, int, int, int] | None = None
+    """已占用格子的范围 `(min_cx, max_cx, min_cz, max_cz)`"""
+    _entries: Dict[str, Tuple[int, Cell]] = field(
+        default_factory=dict, repr=False)
+    """站点 id -> `(插入序号, 格子)`"""
+    _counter: int = field(default=0, repr=False)
+
+    @classmethod
+    def build(
+        cls,
+        stations: Iterable[Station],
+        cell_size: float | None = None,
+    ) -> GridIndex:
+        stations = list(stations)
+        if cell_size is None:
+            cell_size = cls.suggest_cell_size(stations)
+        index = cls(cell_size=cell_size)
+        for station in stations:
+            index.insert(station)
+        return index
+
+    @staticmethod
+    def suggest_cell_size(stations: List[Station]) -> float:
+        """平均每格约 4 个站点"""
+        if len(stations) == 0:
+            return 1.0
+        xs = [station.location.x for station in stations]
+        zs = [station.location.z for station in stations]
+        width = max(xs) - min(xs)
+        height = max(zs) - min(zs)
+        return max(
+            (width * height / len(stations)) ** 0.5 * 2,
+            (width + height) / len(stations),
+            1.0,
+        )
+
+    @staticmethod
+    def is_finite(location: Coord2D) -> bool:
+        """聊天输入的 `inf` / `nan` 等也会被转成 float, 这样的坐标查不到站点"""
+        return isfinite(location.x) and isfinite(location.z)
+
+    def cell_of(self, location: Coord2D) -> Cell:
+        return (
+            floor(location.x / self.cell_size),
+            floor(location.z / self.cell_size),
+        )
+
+    def insert(self, station: Station):
+        """
+        插入站点; 已有同 id 的站点时按新位置移动, 并保留原来的插入序号
+        """
+        if station.id in self._entries:
+            order = self._entries[station.id][0]
+            self.remove(station)
+        else:
+            order = self._counter
+            self._counter += 1
+        cx, cz = cell = self.cell_of(station.location)
+        self._entries[station.id] = (order, cell)
+        self.cells.setdefault(cell, []).append((order, station))
+        if self.bounds is None:
+            self.bounds = (cx, cx, cz, cz)
+        else:
+            min_cx, max_cx, min_cz, max_cz = self.bounds
+            self.bounds = (
+                min(min_cx, cx), max(max_cx, cx),
+                min(min_cz, cz), max(max_cz, cz),
+            )
+
+    def remove(self, station: Station):
+        """
+        按 id 删除, 位置以插入时为准
+        """
+        entry = self._entries.pop(station.id, None)
+        if entry is None:
+            return
+        order, cell = entry
+        bucket = self.cells[cell]
+        bucket[:] = [item for item in bucket if item[0] != order]
+        if len(bucket) == 0:
+            del self.cells[cell]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _rings(self, center: Cell):
+        """
+        由近到远产出 `(r, 第 r 圈内有站点的格子)`
+        """
+        if self.bounds is None:
+            return
+        qx, qz = center
+        min_cx, max_cx, min_cz, max_cz = self.bounds
+        r_min = max(min_cx - qx, qx - max_cx, min_cz - qz, qz - max_cz, 0)
+        r_max = max(qx - min_cx, max_cx - qx, qz - min_cz, max_cz - qz)
+        for r in range(r_min, r_max + 1):
+            ring = []
+            for cx in range(max(qx - r, min_cx), min(qx + r, max_cx) + 1):
+                if cx == qx - r or cx == qx + r:
+                    czs = range(max(qz - r, min_cz), min(qz + r, max_cz) + 1)
+                else:
+                    czs = [cz for cz in (qz - r, qz + r)
+                           if min_cz <= cz <= max_cz]
+                for cz in czs:
+                    bucket = self.cells.get((cx, cz))
+                    if bucket:
+                        ring.append(bucket)
+            yield r, ring
+
+    def nearest(
+        self,
+        location: Coord2D,
+        k: int = 1,
+        distance_mode: DistanceMode = "manhattan",
+        filter: Callable[[Station], bool] = lambda _: True,
+    ) -> List[Tuple[Station, float]]:
+        """
+        最近的 `k` 个站点, 由近到远
+        """
+        if k <= 0 or not self.is_finite(location):
+            return []
+        best: List[Tuple[float, int, Station]] = []
+        """`(-distance, -order, station)` 的大顶堆"""
+        for r, ring in self._rings(self.cell_of(location)):
+            for bucket in ring:
+                for order, station in bucket:
+                    if not filter(station):
+                        continue
+                    distance = location.distance_to(
+                        station.location, mode=distance_mode)
+                    item = (-distance, -order, station)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+            # 更外圈的站点在某一轴上至少相差 r 个格子
+            if len(best) == k and -best[0][0] <= r * self.cell_size:
+                break
+        best.sort(reverse=True)
+        return [(station, -distance) for distance, _, station in best]
+
+    def within(
+        self,
+        location: Coord2D,
+        radius: float,
+        distance_mode: DistanceMode = "manhattan",
+        filter: Callable[[Station], bool] = lambda _: True,
+    ) -> List[Tuple[Station, float]]:
+        """
+        距离不超过 `radius` 的所有站点, 由近到远
+        """
+        if not self.is_finite(location):
+            return []
+        found: List[Tuple[float, int, Station]] = []
+        for r, ring in self._rings(self.cell_of(location)):
+            if (r - 1) * self.cell_size > radius:
+                break
+            for bucket in ring:
+                for order, station in bucket:
+                    if not filter(station):
+                        continue
+                    distance = location.distance_to(
+                        station.location, mode=distance_mode)
+                    if distance <= radius:
+                        found.append((distance, order, station))
+        found.sort(key=lambda item: item[:2])
+        return [(station, distance) for distance, _, station in found]
+
+
+@dataclass
+class StationArray:
+    """
+    站点坐标的 NumPy 数组, 用于批量的最近站点查询
+
+    距离相同时取下标小的站点, 与 `GridIndex` 的插入顺序一致; 需要 NumPy
+    """
+    stations: List[Station]
+    coords: "np.ndarray"
+    """`(2, n)`, 第一行为 x, 第二行为 z, 每行连续存放"""
+
+    @classmethod
+    def build(cls, stations: Iterable[Station]) -> StationArray:
+        stations = list(stations)
+        coords = np.array(
+            [
+                [station.location.x for station in stations],
+                [station.location.z for station in stations],
+            ],
+            dtype=np.float64,
+        ).reshape(2, -1)
+        return cls(stations=stations, coords=coords)
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    def distances(
+        self,
+        xs: "np.ndarray",
+        zs: "np.ndarray",
+        distance_mode: DistanceMode = "manhattan",
+    ) -> "np.ndarray":
+        """查询点 `(xs, zs)` 到所有站点的 `(m, n)` 距离矩阵"""
+        dx = np.abs(xs[:, None] - self.coords[0])
+        dz = np.abs(zs[:, None] - self.coords[1])
+        if distance_mode == "manhattan":
+            dx += dz
+            return dx
+        elif distance_mode == "euclidean":
+            # 与 `Coord2D.distance_to` 的算法一致, 保证并列的判断相同
+            dx *= dx
+            dz *= dz
+            dx += dz
+            return np.sqrt(dx, out=dx)
+        raise ValueError(f"Invalid mode `{distance_mode}`")
+
+    def nearest_many(
+        self,
+        locations: List[Coord2D],
+        k: int = 1,
+        distance_mode: DistanceMode = "manhattan",
+    ) -> List[List[Tuple[Station, float]]]:
+        """
+        每个查询点最近的 `k` 个站点, 由近到远
+        """
+        n = len(self.stations)
+        k = min(k, n)
+        if k <= 0:
+            return [[] for _ in locations]
+        finite = [GridIndex.is_finite(location) for location in locations]
+        if not all(finite):
+            # 同 `GridIndex.nearest`, 非有限的坐标没有候选
+            found = iter(self.nearest_many(
+                [loc for loc, ok in zip(locations, finite) if ok],
+                k, distance_mode))
+            return [next(found) if ok else [] for ok in finite]
+        xs = np.array([location.x for location in locations], dtype=np.float64)
+        zs = np.array([location.z for location in locations], dtype=np.float64)
+        res: List[List[Tuple[Station, float]]] = []
+        step = max(1, BATCH_CHUNK // n)
+        for begin in range(0, len(locations), step):
+            distances = self.distances(
+                xs[begin:begin + step], zs[begin:begin + step], distance_mode)
+            if k < n:
+                # 第 k 小的距离以内的都是候选, 并列时候选可能多于 k 个
+                kth = np.partition(distances, k - 1, axis=1)[:, k - 1:k]
+                rows, cols = np.nonzero(distances <= kth)
+            else:
+                rows, cols = np.nonzero(np.ones_like(distances, dtype=bool))
+            values = distances[rows, cols]
+            # 每行内按 (距离, 下标) 排序, 取前 k 个
+            order = np.lexsort((cols, values, rows))
+            rows, cols, values = rows[order], cols[order], values[order]
+            starts = np.searchsorted(rows, np.arange(len(distances)))
+            keep = np.arange(len(rows)) - starts[rows] < k
+            cols = cols[keep].reshape(-1, k).tolist()
+            values = values[keep].reshape(-1, k).tolist()
+            stations = self.stations
+            res.extend(
+                [(stations[i], d) for i, d in zip(row_cols, row_values)]
+                for row_cols, row_values in zip(cols, values)
+            )
+        return res
@@ -0,0 +1,164 @@
+"""
+生成格式 2 的合成地铁数据, 用于基准测试
+
+线路沿随机方向延伸, 经过已有站点附近时直接共用 (换乘站);
+一部分线路为环线, 一部分在中途分叉 (站点序列中回到分叉站再沿支线延伸)
+"""
+from __future__ import annotations
+
+import math
+import random
+from typing import Dict, List, Tuple
+
+NAME_CHARS = (
+    "东西南北中山海河湖江城门桥园路街港湾岛村镇花林石金银龙凤云星月"
+    "天地水火风雷泉溪松柏竹梅兰菊春夏秋冬新旧长宁安平和清明光华"
+)
+"""站名用字"""
+STATION_SPACING = 300.0
+"""相邻站点的平均距离 (格)"""
+
+
+def station_name(rng: random.Random, used: set) -> str:
+    """不重复的 2~4 字站名"""
+    while True:
+        length = rng.choice((2, 2, 3, 3, 4))
+        name = "".join(rng.choice(NAME_CHARS) for _ in range(length))
+        if name not in used:
+            used.add(name)
+            return name
+
+
+def generate_map(
+    stations: int = 1000,
+    lines: int | None = None,
+    loop_ratio: float = 0.15,
+    branch_ratio: float = 0.15,
+    disabled_ratio: float = 0.05,
+    seed: int = 0,
+    version: str = "2.1",
+) -> dict:
+    """
+    约 `stations` 个站点的格式 2 地图数据 (可以直接 `json.dump`)
+
+    `lines` 默认为每条线约 20 站; `loop_ratio` / `branch_ratio`
+    为环线 / 分叉线路的比例
+    """
+    rng = random.Random(seed)
+    if lines is None:
+        lines = max(1, stations // 16)
+    per_line = max(3, round(stations * 1.15 / lines))
+    extent = STATION_SPACING * math.sqrt(stations) / 2
+
+    used_names: set = set()
+    station_data: Dict[str, dict] = {}
+    coords: List[Tuple[float, float]] = []
+    grid: Dict[Tuple[int, int], List[str]] = {}
+    """按 `STATION_SPACING` 分格, 用于找附近的已有站点"""
+
+    def cell(x: float, z: float) -> Tuple[int, int]:
+        return (math.floor(x / STATION_SPACING),
+                math.floor(z / STATION_SPACING))
+
+    def nearby(x: float, z: float) -> str | None:
+        cx, cz = cell(x, z)
+        best, best_distance = None, STATION_SPACING / 3
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                for id in grid.get((cx + dx, cz + dz), ()):
+                    sx, sz = coords[int(id[1:])]
+                    distance = abs(sx - x) + abs(sz - z)
+                    if distance < best_distance:
+                        best, best_distance = id, distance
+        return best
+
+    def stop_at(x: float, z: float, share: bool = True) -> str:
+        """在 `(x, z)` 设站, 附近已有站点时直接共用"""
+        if share:
+            existing = nearby(x, z)
+            if existing is not None:
+                return existing
+        id = f"s{len(coords)}"
+        x, z = round(x), round(z)
+        coords.append((x, z))
+        grid.setdefault(cell(x, z), []).append(id)
+        name = station_name(rng, used_names)
+        station_data[id] = {
+            "name": {"zh": name, "en": f"Station {len(coords)}"},
+            "coordinates": [x, z],
+            "status": "disabled" if rng.random() < disabled_ratio
+            else "enabled",
+        }
+        return id
+
+    def walk(
+        start: str,
+        heading: float,
+        count: int,
+    ) -> List[str]:
+        """从 `start` 站出发大致沿 `heading` 方向设 `count` 个站"""
+        x, z = coords[int(start[1:])]
+        res: List[str] = [start]
+        for _ in range(count):
+            heading += rng.gauss(0, 0.35)
+            step = STATION_SPACING * rng.uniform(0.6, 1.4)
+            x = max(-extent, min(extent, x + step * math.cos(heading)))
+            z = max(-extent, min(extent, z + step * math.sin(heading)))
+            id = stop_at(x, z)
+            if id not in res[-2:]:
+                res.append(id)
+        return res[1:]
+
+    line_data: Dict[str, dict] = {}
+    for no in range(lines):
+        kind = rng.random()
+        if kind < loop_ratio:
+            # 环线: 围绕一点的近似圆, 首尾相连
+            cx, cz = rng.uniform(-extent, extent), rng.uniform(-extent, extent)
+            radius = per_line * STATION_SPACING / (2 * math.pi)
+            sequence: List[str] = []
+            for i in range(per_line):
+                angle = 2 * math.pi * i / per_line
+                id = stop_at(cx + radius * math.cos(angle),
+                             cz + radius * math.sin(angle))
+                if id not in sequence:
+                    sequence.append(id)
+            circular = len(sequence) >= 3
+        else:
+            start = stop_at(rng.uniform(-extent, extent),
+                            rng.uniform(-extent, extent))
+            heading = rng.uniform(0, 2 * math.pi)
+            sequence = [start] + walk(start, heading, per_line - 1)
+            sequence = [id for i, id in enumerate(sequence)
+                        if id not in sequence[:i]]
+            if kind < loop_ratio + branch_ratio and len(sequence) >= 4:
+                # 分叉: 沿原路退回中途的一站, 再沿另一个方向延伸,
+                # 重复经过的区间不产生新的边
+                fork = rng.randrange(1, len(sequence) - 2)
+                branch = walk(sequence[fork],
+                              heading + rng.choice((-1, 1)) * 1.2,
+                              per_line // 3)
+                branch = branch[:next(
+                    (i for i, id in enumerate(branch) if id in sequence),
+                    len(branch),
+                )]
+                if len(branch) > 0:
+                    sequence = (sequence + sequence[-2:fork - 1:-1]
+                                + branch)
+            circular = False
+        line_data[f"L{no + 1}"] = {
+            "name": {"zh": f"{no + 1}号线", "en": f"Line {no + 1}"},
+            "stations": sequence,
+            "circle": circular,
+        }
+
+    # 补足孤立站点 (不在任何线路上, 只能步行到达)
+    while len(coords) < stations:
+        stop_at(rng.uniform(-extent, extent), rng.uniform(-extent, extent),
+                share=False)
+
+    return {
+        "version": version,
+        "stations": station_data,
+        "lines": line_data,
+    }
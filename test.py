@@ -1,97 +1,457 @@
+"""
+进程内的并发压测: 用线程池驱动 `navigate_metro`, 或用 asyncio 驱动与插件导航命令
+相同的处理流程 (`handle_message`), 报告吞吐量和延迟分位数,
+并把每个结果与串行执行及朴素的参考实现对照
+
+插件本身依赖 nonebot, 这里不导入它, 只复现处理函数中与导航有关的部分;
+不联网, 不删除数据文件; 当前目录没有 `metro_data.json` 时使用合成地图
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import json
+import logging
+import math
 import os
-import subprocess
 import random
-from lib.metro import load_metro_data, MAP
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import lib.metro as metro
+import lib.navigate as navigate
+from lib.fuzzymatching import MATCH_THRESHOLD, lazy_pinyin, weighted_ratio
+from lib.holder import MapState
+from lib.metrics import summarize
+from lib.model import L10N_LANG, Itinerary, MetroMap, Station
+from lib.synthetic import generate_map
+
+QUERY_KINDS = ("name", "coord", "mixed")
+"""站名 -> 站名, 坐标 -> 坐标, 站名和坐标混合"""
+DEFAULT_MIX = "0.4,0.3,0.3"
+LATENCY_PERCENTILES = (50, 95, 99)
+"""报告的延迟分位数"""
+EPSILON = 1e-6
+"""比较距离时的相对误差"""
+
+
+def load_map(data: str | None, stations: int, seed: int) -> MetroMap:
+    """
+    读取 `data` 指定的数据文件; 没有指定且当前目录也没有时生成合成地图
+    """
+    if data is None and os.path.exists(metro.file_path):
+        data = metro.file_path
+    if data is None:
+        # 合成地图及其快照只在加载时需要, 之后整个目录删除
+        with tempfile.TemporaryDirectory(prefix="metro-load-") as directory:
+            data = os.path.join(directory, "metro_data.json")
+            with open(data, 'w', encoding='utf-8') as f:
+                json.dump(generate_map(stations, seed=seed), f,
+                          ensure_ascii=False)
+            metro_map = metro.load_metro_data(data)
+    else:
+        metro_map = metro.load_metro_data(data)
+    # 参考实现需要模糊匹配, 提前导入拼音库, 不计入第一个查询
+    lazy_pinyin("")
+    return metro_map
+
+
+def generate_queries(
+    metro_map: MetroMap,
+    count: int,
+    mix: List[float],
+    seed: int,
+) -> List[Tuple[str, str]]:
+    """
+    `(类型, 查询文本)`, 查询文本是机器人收到的消息, 以空格分隔参数
+
+    站名中约一半为原名, 其余为拼音, 少一个字或换一个字;
+    坐标在某个站点附近随机偏移
+    """
+    rng = random.Random(seed)
+    stations = list(metro_map.stations.values())
+
+    def name() -> str:
+        station = rng.choice(stations)
+        text = str(station.name)
+        kind = rng.random()
+        if kind < 0.5:
+            return text
+        if kind < 0.7:
+            return "".join(lazy_pinyin(text))
+        i = rng.randrange(len(text))
+        if kind < 0.85 and len(text) > 2:
+            return text[:i] + text[i + 1:]
+        return text[:i] + rng.choice("东西南北中山") + text[i + 1:]
+
+    def coord() -> str:
+        location = rng.choice(stations).location
+        return (f"{round(location.x + rng.uniform(-500, 500))} "
+                f"{round(location.z + rng.uniform(-500, 500))}")
+
+    makers: Dict[str, Callable[[], str]] = {
+        "name": lambda: f"{name()} {name()}",
+        "coord": lambda: f"{coord()} {coord()}",
+        "mixed": lambda: (f"{name()} {coord()}" if rng.random() < 0.5
+                          else f"{coord()} {name()}"),
+    }
+    kinds = rng.choices(QUERY_KINDS, weights=mix, k=count)
+    return [(kind, makers[kind]()) for kind in kinds]
+
+
+def call(query: str) -> str:
+    """与插件相同: 按空格拆分后调用; 异常也作为结果比较"""
+    try:
+        return navigate.navigate_metro(*query.split(' '))
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
 
-error_log = []
+async def handle_message(query: str) -> str:
+    """
+    插件 `metro_default` 处理函数的导航部分: 按空格拆分消息,
+    没有参数时提示, 否则 await `navigate_metro_async`; 异常也作为结果比较
+    """
+    args = query.split(' ')
+    if not args:
+        return '请提供起点和终点坐标或站名。'
+    try:
+        return await navigate.navigate_metro_async(*args)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def run_threads(
+    queries: List[str],
+    workers: int,
+) -> Tuple[List[str], List[float], float]:
+    """返回 `(各查询的结果, 各查询的耗时, 总耗时)`"""
+    def timed(query: str) -> Tuple[str, float]:
+        start = time.perf_counter()
+        res = call(query)
+        return res, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(timed, queries))
+    elapsed = time.perf_counter() - start
+    return [r for r, _ in results], [t for _, t in results], elapsed
+
+
+def run_asyncio(
+    queries: List[str],
+    workers: int,
+) -> Tuple[List[str], List[float], float]:
+    """
+    `workers` 个协程并发地 await `handle_message`,
+    实际执行的线程数由 `navigate.NAVIGATION_WORKERS` 决定, 耗时含排队
+    """
+    outputs: List[str] = [""] * len(queries)
+    latencies: List[float] = [0.0] * len(queries)
+    pending = iter(range(len(queries)))
+
+    async def worker():
+        for i in pending:
+            start = time.perf_counter()
+            outputs[i] = await handle_message(queries[i])
+            latencies[i] = time.perf_counter() - start
 
+    async def main():
+        await asyncio.gather(*(worker() for _ in range(workers)))
 
-def get_random_station():
-    """用于产生随机站名"""
-    if MAP is None:
-        load_metro_data()
-    data = MAP
-    random_station = random.choice(list(data.stations.values())).name["zh"]
-    return random_station
+    start = time.perf_counter()
+    asyncio.run(main())
+    return outputs, latencies, time.perf_counter() - start
 
 
-def get_random_coords():
-    """用于随机抽选出某站的(x, z)坐标"""
-    if MAP is None:
-        load_metro_data()
-    data = MAP
-    random_coords = random.choice(list(data.stations.values())).location
-    return random_coords
+# 参考实现: 不用索引, 缓存和启发式, 只用于对照
 
 
-def get_random_coords_value():
-    """用于随机选择坐标数值"""
-    xandz = get_random_coords()
-    return random.choice([xandz.x, xandz.z])
+class ReferenceNames:
+    """
+    不用 `StationNameIndex` 的站名查找, 只由 `metro_map.stations` 和
+    `lazy_pinyin` 构建, 逐个站点比较; 站名的拼音在构建时算一次,
+    打分同 `fuzzy_match_integrated`
+    """
 
+    def __init__(self, metro_map: MetroMap):
+        self.stations = list(metro_map.stations.values())
+        self.names = [
+            station.name.get(L10N_LANG) or str(station.name)
+            for station in self.stations
+        ]
+        self.syllables = [lazy_pinyin(name) for name in self.names]
+        self.pinyins = ["".join(syllables) for syllables in self.syllables]
 
-def generate_random_coords_as_str(num):
-    """用于产生指定数量个随机坐标"""
-    coords = []
-    for _ in range(num):
-        coords.append(str(get_random_coords_value()))
-    return coords
+    def score(self, station: Station, query: str) -> float:
+        i = self.stations.index(station)
+        return weighted_ratio(self.names[i], self.pinyins[i],
+                              query, "".join(lazy_pinyin(query)))
 
+    def resolve(self, query: str) -> Tuple[float, Station | None]:
+        """
+        `(分数, 站点)`; 完整站名或唯一的全拼 / 首字母命中时分数为无穷大,
+        否则对全部站点模糊打分取最高, 并列时取靠前的
+        """
+        key = query.casefold()
+        for station in self.stations:
+            if any(value.casefold() == key for value in station.name.values()):
+                return float("inf"), station
+        pinyin = "".join(lazy_pinyin(query))
+        matches = [
+            station
+            for station, syllables in zip(self.stations, self.syllables)
+            if pinyin.casefold() in (
+                "".join(syllables),
+                "".join(s[0] for s in syllables if s),
+            )
+        ]
+        if len(matches) == 1:
+            return float("inf"), matches[0]
+        best_score, best = -1.0, None
+        for station, name, station_pinyin in zip(
+                self.stations, self.names, self.pinyins):
+            score = weighted_ratio(name, station_pinyin, query, pinyin)
+            if score >= MATCH_THRESHOLD and score > best_score:
+                best_score, best = score, station
+        return best_score, best
 
-def run_commands():
-    """运行命令并且捕获异常"""
-    for command in commands:
-        try:
-            print(f"Running command: {' '.join(command)}")
-            result = subprocess.run(command, check=True)
-            print(f"Command succeeded: {result}")
-        except subprocess.CalledProcessError as e:
-            error_log.append(f"Error running command: - {e}")
-        except Exception as e:
-            error_log.append(f"Unexpected error: {e}")
 
+def reference_nearest(metro_map: MetroMap, x: float, z: float) -> List[float]:
+    """最近 `ENDPOINT_CANDIDATES` 个站点的曼哈顿距离"""
+    return sorted(
+        abs(station.location.x - x) + abs(station.location.z - z)
+        for station in metro_map.stations.values()
+    )[:navigate.ENDPOINT_CANDIDATES]
 
-def delete_metro_data():
-    """删除数据文件"""
-    if os.path.exists("metro_data.json"):
-        os.remove("metro_data.json")
 
+def reference_cost(
+    metro_map: MetroMap,
+    sources: List[Tuple[Station, float]],
+    targets: List[Tuple[Station, float]],
+) -> Tuple[float, int]:
+    """
+    `(站点, 线路)` 状态上的 Dijkstra, 返回 `(代价, 换乘次数)`,
+    代价的算法同 `MetroMap.plan_route`
+    """
+    walk_weight = navigate.WALK_WEIGHT
+    transfer_cost = navigate.TRANSFER_COST
+    lines_at: Dict[str, List[str]] = {}
+    for line_id, line in metro_map.lines.items():
+        for id in line.routes.routes:
+            if id in metro_map.stations:
+                lines_at.setdefault(id, []).append(line_id)
+    walk_to = {station.id: walk for station, walk in targets}
+    best = (float("inf"), 0)
+    for station, walk in sources:
+        if station.id in walk_to:
+            best = min(best, (walk_weight * (walk + walk_to[station.id]), 0))
+    score: Dict[Tuple[str, str], Tuple[float, int]] = {}
+    heap = []
+    for station, walk in sources:
+        for line_id in lines_at.get(station.id, ()):
+            state = (station.id, line_id)
+            if (walk_weight * walk, 0) < score.get(state, (math.inf, 0)):
+                score[state] = (walk_weight * walk, 0)
+                heapq.heappush(heap, (walk_weight * walk, 0, state))
+    done = set()
+    while heap:
+        cost, transfers, state = heapq.heappop(heap)
+        if state in done:
+            continue
+        done.add(state)
+        id, line_id = state
+        if id in walk_to:
+            best = min(best, (cost + walk_weight * walk_to[id], transfers))
+        moves = [
+            ((neighbor, line_id), cost + weight, transfers)
+            for neighbor, weight in
+            metro_map.lines[line_id].routes.routes[id].items()
+            if neighbor in metro_map.stations
+        ]
+        moves.extend(
+            ((id, other), cost + transfer_cost, transfers + 1)
+            for other in lines_at[id] if other != line_id
+        )
+        for next_state, next_cost, next_transfers in moves:
+            if (next_cost, next_transfers) < score.get(
+                    next_state, (math.inf, 0)):
+                score[next_state] = (next_cost, next_transfers)
+                heapq.heappush(heap, (next_cost, next_transfers, next_state))
+    return best
 
-# 构建 commands
 
+def itinerary_cost(itinerary: Itinerary) -> Tuple[float, int]:
+    if itinerary.start_station is None:
+        return float("inf"), 0
+    transfers = max(0, len(itinerary.legs) - 1)
+    return (
+        navigate.WALK_WEIGHT * (itinerary.start_walk + itinerary.end_walk)
+        + itinerary.distance + navigate.TRANSFER_COST * transfers,
+        transfers,
+    )
 
-commands = [
-    ["python", "cli.py", "--metro"]
-    + generate_random_coords_as_str(4),  # 生成4个随机坐标
-    ["python", "cli.py", "--metro"]
-    + generate_random_coords_as_str(2)
-    + [get_random_station()],
-    ["python", "cli.py", "--metro", get_random_station()]
-    + generate_random_coords_as_str(2),
-    ["python", "cli.py", "--metro", get_random_station(), get_random_station()],
-    ["python", "cli.py", "--liststation"],
-    ["python", "cli.py", "--update"],
-]
 
-run_commands()  # 测试直接运行
+def close(a: float, b: float) -> bool:
+    if math.isinf(a) or math.isinf(b):
+        return a == b
+    return abs(a - b) <= EPSILON * max(1.0, abs(a), abs(b))
 
-for command in commands:
+
+def check_reference(
+    state: MapState,
+    names: ReferenceNames,
+    query: str,
+) -> List[str]:
+    """
+    与参考实现不一致之处; 同分的站点 / 同代价的路线都算一致
+    """
+    metro_map = state.metro_map
+    problems = []
+    args = list(map(navigate.soft_float_assert, query.split(' ')))
+    for value in args:
+        if isinstance(value, str):
+            score, expected = names.resolve(value)
+            actual = metro_map.find_station_by_name(value)
+            if (actual is None) != (expected is None):
+                problems.append(f"站名 {value}: {actual} != {expected}")
+            elif actual is not None and actual is not expected:
+                actual_score = names.score(actual, value)
+                if actual_score < score - EPSILON:
+                    problems.append(
+                        f"站名 {value}: {actual.name} ({actual_score:.1f}) "
+                        f"!= {expected.name} ({score:.1f})")
     try:
-        # 测试在没有数据文件的情况下运行
-        delete_metro_data()
-        print(f"Running command: {' '.join(command)}")
-        result = subprocess.run(command, check=True)
-        print(f"Command succeeded: {result}")
-    except subprocess.CalledProcessError as e:
-        error_log.append(f"Error running command: - {e}")
-    except Exception as e:
-        error_log.append(f"Unexpected error: {e}")
+        start, end = navigate.resolve_endpoints(state, args)
+    except ValueError:
+        return problems
+    for candidates, values in ((start, args[:2]), (end, args[-2:])):
+        if not isinstance(values[0], str) and not isinstance(values[1], str):
+            expected = reference_nearest(metro_map, *values)
+            actual = [d for _, d in candidates]
+            if len(actual) != len(expected) or not all(
+                    close(a, b) for a, b in zip(actual, expected)):
+                problems.append(f"最近站点 {values}: {actual} != {expected}")
+    itinerary = metro_map.plan_route(
+        start, end,
+        walk_weight=navigate.WALK_WEIGHT,
+        transfer_cost=navigate.TRANSFER_COST,
+        line_aware=navigate.LINE_AWARE_ROUTING,
+    )
+    actual_cost, actual_transfers = itinerary_cost(itinerary)
+    expected_cost, expected_transfers = reference_cost(metro_map, start, end)
+    if not close(actual_cost, expected_cost):
+        problems.append(f"路线代价: {actual_cost} != {expected_cost}")
+    elif (metro_map.path_table is None and not math.isinf(actual_cost)
+          and (navigate.LINE_AWARE_ROUTING or navigate.TRANSFER_COST > 0)
+          and actual_transfers != expected_transfers):
+        # 只有区分线路的寻路保证换乘次数最少
+        problems.append(
+            f"换乘次数: {actual_transfers} != {expected_transfers}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DHW Inf地铁导航并发压测 (进程内, 无需联网)。")
+    parser.add_argument("--data", default=None,
+                        help="数据文件, 默认当前目录的 metro_data.json, "
+                             "没有时使用合成地图")
+    parser.add_argument("--stations", type=int, default=2000,
+                        help="合成地图的站点数")
+    parser.add_argument("--queries", type=int, default=2000,
+                        help="查询总数")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="站名 / 坐标 / 混合 查询的比例")
+    parser.add_argument("--mode", choices=["thread", "asyncio"],
+                        default="thread",
+                        help="thread 直接调用 navigate_metro, "
+                             "asyncio 经与插件处理函数相同的流程调用 "
+                             "navigate_metro_async")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="并发的线程 / 协程数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-check", action="store_true",
+                        help="不与串行结果和参考实现对照")
+    parser.add_argument("--json", action="store_true",
+                        help="以 JSON 输出结果, 便于比较")
+    args = parser.parse_args()
+    # 随机查询中无路线很常见, 不逐条打印警告
+    logging.getLogger("lib").setLevel(logging.ERROR)
+
+    mix = [float(value) for value in args.mix.split(",")]
+    if len(mix) != len(QUERY_KINDS):
+        parser.error(f"--mix 需要 {len(QUERY_KINDS)} 个比例")
+    metro_map = load_map(args.data, args.stations, args.seed)
+    queries = generate_queries(metro_map, args.queries, mix, args.seed)
+    texts = [query for _, query in queries]
+    state = metro.get_state()
+
+    state.clear_caches()
+    run = run_threads if args.mode == "thread" else run_asyncio
+    outputs, latencies, elapsed = run(texts, args.workers)
+    report = {
+        "map": {"version": str(metro_map.version),
+                "stations": len(metro_map.stations),
+                "lines": len(metro_map.lines)},
+        "mode": args.mode,
+        "workers": args.workers,
+        "throughput": len(texts) / elapsed,
+        "latency": summarize(latencies, LATENCY_PERCENTILES),
+        "by_kind": {
+            kind: summarize([t for (k, _), t in zip(queries, latencies)
+                             if k == kind], LATENCY_PERCENTILES)
+            for kind in QUERY_KINDS
+        },
+        "cache": navigate.cache_stats(),
+    }
+
+    problems: List[str] = []
+    if not args.no_check:
+        # 清空缓存后串行执行一遍, 并发结果应与之完全相同
+        state.clear_caches()
+        expected: Dict[str, str] = {}
+        for query, output in zip(texts, outputs):
+            if query not in expected:
+                expected[query] = call(query)
+            if output != expected[query]:
+                problems.append(f"{query}: 并发结果与串行结果不同")
+        names = ReferenceNames(metro_map)
+        for query in expected:
+            problems.extend(
+                f"{query}: {problem}"
+                for problem in check_reference(state, names, query))
+        report["checked"] = len(expected)
+        report["mismatches"] = len(problems)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"地图 {report['map']['version']}: "
+              f"{report['map']['stations']} 站, {report['map']['lines']} 线; "
+              f"{args.mode} x {args.workers}")
+        print(f"吞吐量 {report['throughput']:.1f} 次/秒")
+        print(f"{'kind':<8}{'count':>7}{'mean':>10}{'p50':>10}"
+              f"{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+        for kind, stats in [("all", report["latency"]),
+                            *report["by_kind"].items()]:
+            print(f"{kind:<8}{stats['count']:>7}" + "".join(
+                f"{stats[key]:>10.3f}"
+                for key in ("mean", "p50", "p95", "p99", "max")))
+        for name, stats in report["cache"].items():
+            print(f"cache.{name}: hits={stats['hits']}, "
+                  f"misses={stats['misses']}, "
+                  f"hit_ratio={stats['hit_ratio']:.3f}")
+        if not args.no_check:
+            print(f"对照 {report['checked']} 个不同查询, "
+                  f"{report['mismatches']} 处不一致")
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    if len(problems) > 0:
+        sys.exit(1)
 
-if error_log:
-    print("\nErrors encountered:")
-    for error in error_log:
-        print(error)
-else:
-    print("All commands succeeded.")
 
-input("Press Enter to continue...")
+if __name__ == "__main__":
+    main()